@@ -0,0 +1,67 @@
+"""
+Benchmark vis_utils.decode_label_map against the previous implementation that loops over every pixel
+Usage: PYTHONPATH=. python benchmarks/bench_decode_label_map.py [--size 512] [--label_num 5], or with toolman installed
+"""
+
+
+# Built-in
+import time
+import argparse
+
+# Libs
+import numpy as np
+
+# Own modules
+from toolman import vis_utils
+
+
+def decode_label_map_loop(label, label_num=2, label_colors=None):
+    """
+    The previous implementation of decode_label_map
+    """
+    if len(label.shape) == 3:
+        label = np.expand_dims(label, -1)
+    n, h, w, c = label.shape
+    outputs = np.zeros((n, h, w, 3), dtype=np.uint8)
+    if not label_colors:
+        color_list = vis_utils.get_color_list()
+        label_colors = {}
+        for i in range(label_num):
+            label_colors[i] = color_list[i]
+        label_colors[0] = (255, 255, 255)
+    for i in range(n):
+        pixels = np.zeros((h, w, 3), dtype=np.uint8)
+        for j in range(h):
+            for k in range(w):
+                pixels[j, k] = label_colors[int(label[i, j, k, 0])]
+        outputs[i] = pixels
+    return outputs
+
+
+def time_func(func, repeat, *args):
+    durations = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        output = func(*args)
+        durations.append(time.perf_counter() - start_time)
+    return np.median(durations), output
+
+
+def main(size, label_num, repeat):
+    label = np.random.randint(0, label_num, (1, size, size))
+    loop_time, loop_output = time_func(decode_label_map_loop, 1, label, label_num)
+    vec_time, vec_output = time_func(vis_utils.decode_label_map, repeat, label, label_num)
+    np.testing.assert_array_equal(loop_output, vec_output)
+    print('{}x{} label map, {} classes'.format(size, size, label_num))
+    print('{:<12} {:>10.4f}s'.format('loop', loop_time))
+    print('{:<12} {:>10.4f}s'.format('vectorized', vec_time))
+    print('speedup: {:.1f}x'.format(loop_time / vec_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--label_num', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    main(args.size, args.label_num, args.repeat)
@@ -0,0 +1,58 @@
+"""
+Benchmark the import time of toolman and each of its submodules, every import is measured in a fresh interpreter
+Usage: python benchmarks/bench_import.py [--repeat 5]
+"""
+
+
+# Built-in
+import sys
+import argparse
+import subprocess
+
+# Libs
+import numpy as np
+
+# Own modules
+
+# Settings
+TARGETS = [
+    'toolman',
+    'toolman.misc_utils',
+    'toolman.process_block',
+    'toolman.debug_utils',
+    'toolman.img_utils',
+    'toolman.vis_utils',
+    'toolman.pytorch_utils',
+]
+HEAVY_MODULES = ['torch', 'torchvision', 'cv2', 'matplotlib', 'skimage', 'pandas']
+
+
+def time_import(module_name):
+    """
+    Import the module in a fresh interpreter
+    :param module_name: the module to be imported
+    :return: import time in seconds and the heavy libraries loaded by the import
+    """
+    code = ('import sys, time; start = time.perf_counter(); import {}; duration = time.perf_counter() - start; '
+            'print(duration); print(",".join(m for m in {} if m in sys.modules))').format(module_name, HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', code]).decode().split('\n')
+    return float(output[0]), output[1]
+
+
+def main(repeat):
+    print('{:<25} {:>10} {:>10}  {}'.format('module', 'median(s)', 'min(s)', 'heavy libraries loaded'))
+    for target in TARGETS:
+        try:
+            results = [time_import(target) for _ in range(repeat)]
+        except subprocess.CalledProcessError:
+            print('{:<25} {:>10}'.format(target, 'failed'))
+            continue
+        durations = [a[0] for a in results]
+        print('{:<25} {:>10.3f} {:>10.3f}  {}'.format(target, np.median(durations), np.min(durations), results[0][1]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    main(args.repeat)
@@ -14,6 +14,7 @@ setup(name='toolman',
       author_email='hbhzhuce@gmail.com',
       license='MIT',
       packages=['toolman'],
+      python_requires='>=3.7',
       long_description=readme(),
       install_requires=[
             'numpy',
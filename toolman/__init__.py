@@ -1,6 +1,26 @@
-import toolman.misc_utils
-import toolman.img_utils
-import toolman.pytorch_utils
-import toolman.process_block
-import toolman.vis_utils
-import toolman.debug_utils
\ No newline at end of file
+"""
+Submodules are imported on first attribute access, e.g. toolman.vis_utils, so that `import toolman` does not pull in
+heavy libraries like torch or matplotlib until they are needed
+"""
+
+
+# Built-in
+import importlib
+
+# Libs
+
+# Own modules
+
+
+__all__ = ['misc_utils', 'img_utils', 'pytorch_utils', 'process_block', 'vis_utils', 'debug_utils']
+
+
+def __getattr__(name):
+    if name in __all__:
+        # importing the submodule also sets it as an attribute of the package
+        return importlib.import_module('.{}'.format(name), __name__)
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
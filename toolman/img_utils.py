@@ -4,14 +4,15 @@
 
 
 # Built-in
+import numbers
+from functools import partial
 
 # Libs
 import cv2
 import numpy as np
-from skimage import measure
 
 # Own modules
-from .misc_utils import load_file
+from .misc_utils import load_file, _iter_map
 
 
 def get_img_channel_num(file_name):
@@ -64,7 +65,40 @@ def binarize_mask(img, thresh=3):
     return img
 
 
-def seg_to_bbox(img, binarize=False, dilate=True, thresh=127, kernel_size=3):
+def _label_components(img, connectivity=8, backend='cv2'):
+    """
+    Find the connected components of the non-zero pixels in one pass
+    :param img: the segmentation mask
+    :param connectivity: 4 or 8, the pixel connectivity
+    :param backend: 'cv2' for cv2.connectedComponentsWithStats, or 'skimage' for skimage.measure.regionprops
+    :return: bboxes as N * 4 array of (min_row, min_col, max_row, max_col), areas as N array and centroids as N * 2
+             array of (row, col), in the raster scan order of the components
+    """
+    if connectivity not in [4, 8]:
+        raise ValueError('connectivity {} not understood, should be either 4 or 8'.format(connectivity))
+    if backend == 'cv2':
+        # SAUF labels in raster scan order, which keeps the output order the same as skimage
+        _, _, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(
+            (img > 0).astype(np.uint8), connectivity, cv2.CV_32S, cv2.CCL_SAUF)
+        # the first component is the background
+        stats, centroids = stats[1:], centroids[1:]
+        bboxes = np.stack([stats[:, cv2.CC_STAT_TOP], stats[:, cv2.CC_STAT_LEFT],
+                           stats[:, cv2.CC_STAT_TOP] + stats[:, cv2.CC_STAT_HEIGHT],
+                           stats[:, cv2.CC_STAT_LEFT] + stats[:, cv2.CC_STAT_WIDTH]], axis=1)
+        return bboxes, stats[:, cv2.CC_STAT_AREA], centroids[:, ::-1]
+    elif backend == 'skimage':
+        from skimage import measure
+        reg_props = measure.regionprops(measure.label(img > 0, connectivity=connectivity // 4))
+        bboxes = np.array([rp.bbox for rp in reg_props], dtype=np.int64).reshape(-1, 4)
+        areas = np.array([rp.area for rp in reg_props], dtype=np.int64)
+        centroids = np.array([rp.centroid for rp in reg_props], dtype=np.float64).reshape(-1, 2)
+        return bboxes, areas, centroids
+    else:
+        raise ValueError('backend {} not understood, should be either cv2 or skimage'.format(backend))
+
+
+def seg_to_bbox(img, binarize=False, dilate=True, thresh=127, kernel_size=3, min_area=50, max_area=None,
+                connectivity=8, backend='cv2', return_stats=False):
     """
     Transform segmentation mask to bounding boxes
     :param img: the segmentation mask
@@ -73,7 +107,13 @@ def seg_to_bbox(img, binarize=False, dilate=True, thresh=127, kernel_size=3):
                    wraps up each object. Notice, this might also merge two nearby objects
     :param thresh: the threshold to binarize the segmenation map
     :param kernel_size: the kernel size for dilation
-    :return:
+    :param min_area: only objects with area larger than this will be kept
+    :param max_area: if given, only objects with area no larger than this will be kept
+    :param connectivity: 4 or 8, the pixel connectivity of the objects
+    :param backend: 'cv2' or 'skimage', the library used to find the connected components
+    :param return_stats: if True, return the bboxes, areas and centroids as numpy arrays
+    :return: list of bboxes as (min_row, min_col, max_row, max_col), or bboxes as N * 4 array, areas as N array and
+             centroids as N * 2 array of (row, col) if return_stats is True
     """
     if isinstance(img, str):
         img = load_file(img)
@@ -87,16 +127,112 @@ def seg_to_bbox(img, binarize=False, dilate=True, thresh=127, kernel_size=3):
         img = cv2.dilate(img, kernel, iterations=1)
 
     # connected components
-    im_label = measure.label(img > 0)
-    reg_props = measure.regionprops(im_label, img)
+    bboxes, areas, centroids = _label_components(img, connectivity, backend)
+    keep = areas > min_area
+    if max_area is not None:
+        keep &= areas <= max_area
+    bboxes, areas, centroids = bboxes[keep], areas[keep], centroids[keep]
+
+    if return_stats:
+        return bboxes, areas, centroids
+    return [tuple(a) for a in bboxes.tolist()]
+
+
+class Polygons(object):
+    """
+    A ragged array of polygons, the vertices of all polygons are stored in one coords array and polygon i is
+    coords[offsets[i]:offsets[i + 1]], so no python object is created for each vertex and the areas and bboxes can be
+    computed with numpy
+    """
+    def __init__(self, coords=None, offsets=None):
+        """
+        :param coords: N * 2 array of the (x, y) vertices of all polygons
+        :param offsets: array of the start index of each polygon in coords, followed by N
+        """
+        self.coords = np.zeros((0, 2), dtype=np.int32) if coords is None else np.asarray(coords)
+        self.offsets = np.zeros(1, dtype=np.int64) if offsets is None else np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_contours(cls, contours):
+        """
+        Create the polygons from cv2 contours, the vertices are copied once into the coords array
+        :param contours: list of contours as returned by cv2.findContours, or list of polygons as lists of [x, y]
+        :return: the Polygons instance
+        """
+        if len(contours) == 0:
+            return cls()
+        offsets = np.zeros(len(contours) + 1, dtype=np.int64)
+        np.cumsum([len(contour) for contour in contours], out=offsets[1:])
+        if not all(isinstance(contour, np.ndarray) and contour.ndim == 3 for contour in contours):
+            contours = [np.asarray(contour).reshape(-1, 2) for contour in contours]
+        # cv2 contours are K * 1 * 2 arrays, they are concatenated without reshaping each of them
+        return cls(np.concatenate(contours).reshape(-1, 2), offsets)
+
+    @property
+    def lengths(self):
+        """
+        Number of vertices of each polygon
+        """
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        """
+        Get one polygon as a view of the coords array if index is an integer, otherwise the selected polygons
+        :param index: integer, slice, list of integers or boolean mask
+        :return: K * 2 array of the vertices or Polygons
+        """
+        if isinstance(index, numbers.Integral):
+            if not -len(self) <= index < len(self):
+                raise IndexError('index {} is out of range for {} polygons'.format(index, len(self)))
+            index = index % len(self)
+            return self.coords[self.offsets[index]:self.offsets[index + 1]]
+        index = np.arange(len(self))[index]
+        lengths = self.lengths[index]
+        offsets = np.zeros(len(index) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # shift each selected polygon from its old start to its new start
+        gather = np.repeat(self.offsets[index] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return Polygons(self.coords[gather], offsets)
+
+    def __iter__(self):
+        return iter(np.split(self.coords, self.offsets[1:-1]))
 
-    # get bboxes
-    bboxes = []
-    for rp in reg_props:
-        if rp.area > 50:
-            bboxes.append(rp.bbox)
+    def __repr__(self):
+        return 'Polygons(polygons={}, vertices={})'.format(len(self), len(self.coords))
 
-    return bboxes
+    def areas(self):
+        """
+        Get the area of each polygon with the shoelace formula, this is the same as cv2.contourArea
+        :return: array of areas
+        """
+        if len(self) == 0:
+            return np.zeros(0)
+        x, y = self.coords[:, 0].astype(np.float64), self.coords[:, 1].astype(np.float64)
+        # index of the next vertex, the last vertex of each polygon connects back to its first one
+        next_idx = np.arange(1, len(self.coords) + 1)
+        next_idx[self.offsets[1:] - 1] = self.offsets[:-1]
+        return np.abs(np.add.reduceat(x * y[next_idx] - x[next_idx] * y, self.offsets[:-1])) / 2
+
+    def bboxes(self):
+        """
+        Get the bounding box of each polygon in the same format as seg_to_bbox
+        :return: N * 4 array of (min_row, min_col, max_row, max_col)
+        """
+        if len(self) == 0:
+            return np.zeros((0, 4), dtype=np.int64)
+        min_xy = np.minimum.reduceat(self.coords, self.offsets[:-1], axis=0)
+        max_xy = np.maximum.reduceat(self.coords, self.offsets[:-1], axis=0) + 1
+        return np.stack([min_xy[:, 1], min_xy[:, 0], max_xy[:, 1], max_xy[:, 0]], axis=1).astype(np.int64)
+
+    def tolist(self):
+        """
+        Convert the polygons to nested lists
+        :return: list of polygons, each one is a list of [x, y]
+        """
+        return [polygon.tolist() for polygon in self]
 
 
 def seg_to_polygon(img, binarize=False, approx=False):
@@ -105,7 +241,7 @@ def seg_to_polygon(img, binarize=False, approx=False):
     :param img: the segmentation mask
     :param binarize: if True, the map will be binarized by a threshold
     :param approx: if True, the polygons will be approximated. Note, this is not working very well some times
-    :return:
+    :return: the polygons as Polygons
     """
     if isinstance(img, str):
         img = load_file(img)
@@ -113,18 +249,316 @@ def seg_to_polygon(img, binarize=False, approx=False):
     if binarize:
         img = binarize_mask(img)
 
+    return Polygons.from_contours(_find_contours(img, approx))
+
+
+def batch_seg_to_bbox(imgs, workers=None, chunksize=16, **kwargs):
+    """
+    Transform a list of segmentation masks to bounding boxes with a pool of worker processes, the masks are submitted
+    in chunks and the results are streamed back in the same order as the masks
+    :param imgs: list of segmentation masks or paths to them
+    :param workers: number of worker processes, if None or 1, the masks will be processed one by one
+    :param chunksize: number of masks submitted to the pool as one task
+    :param kwargs: other parameters used by seg_to_bbox
+    :return: generator of the output of seg_to_bbox for each mask
+    """
+    return _iter_map(partial(seg_to_bbox, **kwargs), imgs, workers, backend='process', chunksize=chunksize)
+
+
+def batch_seg_to_polygon(imgs, workers=None, chunksize=16, **kwargs):
+    """
+    Transform a list of segmentation masks to polygons with a pool of worker processes, the masks are submitted in
+    chunks and the results are streamed back in the same order as the masks
+    :param imgs: list of segmentation masks or paths to them
+    :param workers: number of worker processes, if None or 1, the masks will be processed one by one
+    :param chunksize: number of masks submitted to the pool as one task
+    :param kwargs: other parameters used by seg_to_polygon
+    :return: generator of the output of seg_to_polygon for each mask
+    """
+    return _iter_map(partial(seg_to_polygon, **kwargs), imgs, workers, backend='process', chunksize=chunksize)
+
+
+def _open_raster(img):
+    """
+    Open a raster lazily so that windows of it can be read without loading the whole scene
+    :param img: numpy array or memmap, path to a .npy file, which will be memory mapped, or path to an image file,
+                which will be opened by PIL and decoded at the first read
+    :return: (height, width) of the raster and a function read(r0, r1, c0, c1) returning the window as numpy array
+    """
+    if isinstance(img, str):
+        if img.lower().endswith('.npy'):
+            img = load_file(img, mmap_mode='r')
+        else:
+            pil_img = load_file(img, pil=True)
+            return (pil_img.height, pil_img.width), lambda r0, r1, c0, c1: np.array(pil_img.crop((c0, r0, c1, r1)))
+    return img.shape[:2], lambda r0, r1, c0, c1: np.array(img[r0:r1, c0:c1])
+
+
+def _get_tiles(shape, tile_size, halo=0):
+    """
+    Get the windows to read a raster tile by tile
+    :param shape: (height, width) of the raster
+    :param tile_size: the height and width of each tile, tiles at the right and bottom border could be smaller
+    :param halo: number of extra pixels read around each tile
+    :return: list of (tile_row, tile_col, core window, read window), windows are (r0, r1, c0, c1)
+    """
+    tiles = []
+    for i, r0 in enumerate(range(0, shape[0], tile_size)):
+        for j, c0 in enumerate(range(0, shape[1], tile_size)):
+            r1, c1 = min(r0 + tile_size, shape[0]), min(c0 + tile_size, shape[1])
+            read = (max(r0 - halo, 0), min(r1 + halo, shape[0]), max(c0 - halo, 0), min(c1 + halo, shape[1]))
+            tiles.append((i, j, (r0, r1, c0, c1), read))
+    return tiles
+
+
+def _iter_windows(read, tiles):
+    """
+    Read the windows one by one, this is consumed by the pool so at most prefetch windows are kept in memory
+    :param read: the read function returned by _open_raster
+    :param tiles: list of tiles returned by _get_tiles
+    :return: generator of (window data, core window, read window)
+    """
+    for _, _, core, window in tiles:
+        yield read(*window), core, window
+
+
+def _tile_objects(args, width, binarize=False, dilate=False, kernel_size=3, connectivity=8, polygon=False,
+                  approx=False):
+    """
+    Find the objects in one tile, this runs in the worker processes
+    :param args: (window data, core window, read window)
+    :param width: width of the whole raster, used to compute the global index of pixels
+    :param binarize: if True, the window will be binarized by binarize_mask
+    :param dilate: if True, the window will be dilated before the halo is cropped
+    :param kernel_size: the kernel size for dilation
+    :param connectivity: 4 or 8, the pixel connectivity
+    :param polygon: if True, the contours of each object will be extracted as well
+    :param approx: if True, the contours will be approximated
+    :return: dict of the per object stats in global coordinates, the labels on the four borders of the tile and the
+             contours of each object if polygon is True
+    """
+    tile, (r0, r1, c0, c1), (w_r0, _, w_c0, _) = args
+    if binarize:
+        tile = binarize_mask(tile)
+    if dilate:
+        kernel = np.ones((kernel_size, kernel_size), np.uint8)
+        tile = cv2.dilate(tile, kernel, iterations=1)
+    tile = (tile[r0 - w_r0:r1 - w_r0, c0 - w_c0:c1 - w_c0] > 0).astype(np.uint8)
+    n, labels, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(
+        tile, connectivity, cv2.CV_32S, cv2.CCL_SAUF)
+    stats, centroids = stats[1:], centroids[1:]
+
+    # labels are assigned in raster order, so the first pixel of each object is where the running max increases
+    first = np.flatnonzero(np.diff(np.maximum.accumulate(labels.ravel()), prepend=0))
+    rows, cols = np.divmod(first, labels.shape[1])
+    result = {
+        'first': (rows + r0).astype(np.int64) * width + cols + c0,
+        'bbox': np.stack([stats[:, cv2.CC_STAT_TOP] + r0, stats[:, cv2.CC_STAT_LEFT] + c0,
+                          stats[:, cv2.CC_STAT_TOP] + stats[:, cv2.CC_STAT_HEIGHT] + r0,
+                          stats[:, cv2.CC_STAT_LEFT] + stats[:, cv2.CC_STAT_WIDTH] + c0], axis=1).astype(np.int64),
+        'area': stats[:, cv2.CC_STAT_AREA].astype(np.int64),
+        'centroid': centroids[:, ::-1] + [r0, c0],
+        'top': labels[0].copy(), 'bottom': labels[-1].copy(), 'left': labels[:, 0].copy(),
+        'right': labels[:, -1].copy(),
+    }
+    if polygon:
+        polygons = [[] for _ in range(n - 1)]
+        for contour in _find_contours(tile, approx):
+            # contour points lie on the pixels of the object they belong to
+            polygons[labels[contour[0, 0, 1], contour[0, 0, 0]] - 1].append(contour + [c0, r0])
+        result['polygons'] = polygons
+    return result
+
+
+def _find_contours(img, approx=False):
+    """
+    Find the contours in a binary mask the same way as seg_to_polygon
+    :param img: the binary mask as uint8
+    :param approx: if True, the contours will be approximated
+    :return: list of contours as returned by cv2.findContours
+    """
     contours, hierarchy = cv2.findContours(img, 1, 2)
+    if approx:
+        contours = [cv2.approxPolyDP(contour, 0.1 * cv2.arcLength(contour, True), True) for contour in contours]
+    return contours
+
+
+def _seam_pairs(a, b, connectivity=8):
+    """
+    Get the pairs of labels that touch each other across a seam between two tiles
+    :param a: labels on the border of the first tile
+    :param b: labels on the facing border of the second tile, in the same order as a
+    :param connectivity: 4 or 8, the pixel connectivity
+    :return: N * 2 array of label pairs
+    """
+    pairs = [(a, b)]
+    if connectivity == 8:
+        pairs += [(a[:-1], b[1:]), (a[1:], b[:-1])]
+    pairs = [np.stack([x[(x > 0) & (y > 0)], y[(x > 0) & (y > 0)]], axis=1) for x, y in pairs]
+    return np.concatenate(pairs)
+
+
+def _merge_tiles(results, grid, connectivity=8):
+    """
+    Merge the objects that cross the tile seams with union-find
+    :param results: list of results returned by _tile_objects
+    :param grid: (tile_row, tile_col) of each result
+    :param connectivity: 4 or 8, the pixel connectivity
+    :return: the global index of the group each object belongs to, number of groups
+    """
+    offsets = np.cumsum([0] + [len(r['area']) for r in results])
+    index = {pos: k for k, pos in enumerate(grid)}
+    pairs = []
+    for k, (i, j) in enumerate(grid):
+        neighbors = [((i, j + 1), 'right', 'left', slice(None), slice(None)),
+                     ((i + 1, j), 'bottom', 'top', slice(None), slice(None))]
+        if connectivity == 8:
+            neighbors += [((i + 1, j + 1), 'bottom', 'top', slice(-1, None), slice(0, 1)),
+                          ((i + 1, j - 1), 'bottom', 'top', slice(0, 1), slice(-1, None))]
+        for pos, side_a, side_b, slice_a, slice_b in neighbors:
+            if pos not in index:
+                continue
+            other = index[pos]
+            pair = _seam_pairs(results[k][side_a][slice_a], results[other][side_b][slice_b], connectivity)
+            # labels are 1-based within each tile
+            pairs.append(pair + [offsets[k] - 1, offsets[other] - 1])
+    parent = np.arange(offsets[-1])
+    if pairs:
+        pairs = np.unique(np.concatenate(pairs), axis=0)
+
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        for a, b in pairs.tolist():
+            root_a, root_b = find(a), find(b)
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+        for x in range(len(parent)):
+            parent[x] = find(x)
+    groups, inverse = np.unique(parent, return_inverse=True)
+    return inverse, len(groups)
+
+
+def _tiled_objects(img, tile_size, workers, halo=0, connectivity=8, **kwargs):
+    """
+    Find the objects in a raster tile by tile and merge the ones that cross the tile seams
+    :param img: numpy array, memmap or path to the raster, see _open_raster
+    :param tile_size: the height and width of each tile
+    :param workers: number of worker processes, if None or 1, the tiles will be processed one by one
+    :param halo: number of extra pixels read around each tile
+    :param connectivity: 4 or 8, the pixel connectivity
+    :param kwargs: other parameters used by _tile_objects
+    :return: the read function of the raster, the per tile results, the group each object in the tiles belongs to,
+             and the (row, col) of the first pixel, bbox, area and centroid of each group, in raster order
+    """
+    shape, read = _open_raster(img)
+    tiles = _get_tiles(shape, tile_size, halo)
+    func = partial(_tile_objects, width=shape[1], connectivity=connectivity, **kwargs)
+    results = list(_iter_map(func, _iter_windows(read, tiles), workers, backend='process'))
+    group, group_num = _merge_tiles(results, [(i, j) for i, j, _, _ in tiles], connectivity)
+
+    stats = {key: np.concatenate([r[key] for r in results]) for key in ['first', 'bbox', 'area', 'centroid']}
+    first = np.full(group_num, np.iinfo(np.int64).max)
+    np.minimum.at(first, group, stats['first'])
+    bbox = np.full((group_num, 4), np.iinfo(np.int64).max)
+    np.minimum.at(bbox[:, :2], group, stats['bbox'][:, :2])
+    bbox[:, 2:] = np.iinfo(np.int64).min
+    np.maximum.at(bbox[:, 2:], group, stats['bbox'][:, 2:])
+    area = np.bincount(group, weights=stats['area'], minlength=group_num).astype(np.int64)
+    centroid = np.stack([np.bincount(group, weights=stats['centroid'][:, k] * stats['area'], minlength=group_num)
+                         for k in range(2)], axis=1) / np.maximum(area, 1)[:, None]
+
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(group_num)
+    first = np.stack(np.divmod(first[order], shape[1]), axis=1)
+    return read, results, rank[group], first, bbox[order], area[order], centroid[order]
+
+
+def seg_to_bbox_tiled(img, tile_size=4096, workers=None, binarize=False, dilate=True, kernel_size=3, min_area=50,
+                      max_area=None, connectivity=8, return_stats=False):
+    """
+    Transform a large segmentation mask to bounding boxes tile by tile, the tiles are processed in worker processes
+    and the objects crossing the tile seams are merged, the output is the same as seg_to_bbox on the whole mask. The
+    memory usage is bounded by the tile size if img is a numpy memmap or a .npy file
+    :param img: the segmentation mask as numpy array or memmap, or path to a .npy file or an image file
+    :param tile_size: the height and width of each tile
+    :param workers: number of worker processes, if None or 1, the tiles will be processed one by one
+    :param binarize: if True, the map will be binarized by a threshold
+    :param dilate: if True, will dilate the segmentation images first, see seg_to_bbox
+    :param kernel_size: the kernel size for dilation
+    :param min_area: only objects with area larger than this will be kept
+    :param max_area: if given, only objects with area no larger than this will be kept
+    :param connectivity: 4 or 8, the pixel connectivity of the objects
+    :param return_stats: if True, return the bboxes, areas and centroids as numpy arrays
+    :return: list of bboxes as (min_row, min_col, max_row, max_col), or bboxes as N * 4 array, areas as N array and
+             centroids as N * 2 array of (row, col) if return_stats is True
+    """
+    if connectivity not in [4, 8]:
+        raise ValueError('connectivity {} not understood, should be either 4 or 8'.format(connectivity))
+    # the dilation of the pixels in a tile only depends on the pixels within half kernel size around it
+    halo = kernel_size // 2 if dilate else 0
+    _, _, _, _, bboxes, areas, centroids = _tiled_objects(
+        img, tile_size, workers, halo, connectivity, binarize=binarize, dilate=dilate, kernel_size=kernel_size)
+    keep = areas > min_area
+    if max_area is not None:
+        keep &= areas <= max_area
+    bboxes, areas, centroids = bboxes[keep], areas[keep], centroids[keep]
+
+    if return_stats:
+        return bboxes, areas, centroids
+    return [tuple(a) for a in bboxes.tolist()]
+
+
+def _object_contours(args, binarize=False, approx=False):
+    """
+    Extract the contours of one object from a window that covers it, this runs in the worker processes
+    :param args: (window data, (row, col) of a pixel of the object in the window, (row, col) offset of the window)
+    :param binarize: if True, the window will be binarized by binarize_mask
+    :param approx: if True, the contours will be approximated
+    :return: list of contours in global coordinates
+    """
+    window, (row, col), (r0, c0) = args
+    if binarize:
+        window = binarize_mask(window)
+    _, labels = cv2.connectedComponents((window > 0).astype(np.uint8), connectivity=8)
+    mask = (labels == labels[row, col]).astype(np.uint8)
+    return [contour + [c0, r0] for contour in _find_contours(mask, approx)]
+
+
+def seg_to_polygon_tiled(img, tile_size=4096, workers=None, binarize=False, approx=False):
+    """
+    Transform a large segmentation mask to polygons tile by tile, the tiles are processed in worker processes, the
+    objects crossing the tile seams are merged and extracted again from the window of their merged bounding box. The
+    memory usage is bounded by the tile size and the size of the largest object if img is a numpy memmap or a .npy
+    file
+    :param img: the segmentation mask as numpy array or memmap, or path to a .npy file or an image file
+    :param tile_size: the height and width of each tile
+    :param workers: number of worker processes, if None or 1, the tiles will be processed one by one
+    :param binarize: if True, the map will be binarized by a threshold
+    :param approx: if True, the polygons will be approximated
+    :return: the polygons as Polygons, grouped by object in raster order
+    """
+    read, results, group, first, bboxes, _, _ = _tiled_objects(
+        img, tile_size, workers, binarize=binarize, polygon=True, approx=approx)
+    contours = [[] for _ in range(len(first))]
+    for k, polygons in zip(group, (p for r in results for p in r['polygons'])):
+        contours[k].append(polygons)
+    merged = [k for k in range(len(contours)) if len(contours[k]) > 1]
 
-    polygons = []
+    def iter_windows():
+        for k in merged:
+            r0, c0, r1, c1 = bboxes[k]
+            yield read(r0, r1, c0, c1), (first[k, 0] - r0, first[k, 1] - c0), (r0, c0)
 
-    for contour in contours:
-        if approx:
-            epsilon = 0.1 * cv2.arcLength(contour, True)
-            contour = cv2.approxPolyDP(contour, epsilon, True)
-        contour = [a[0].tolist() for a in contour]
-        polygons.append(contour)
+    func = partial(_object_contours, binarize=binarize, approx=approx)
+    for k, polygons in zip(merged, _iter_map(func, iter_windows(), workers, backend='process')):
+        contours[k] = [polygons]
 
-    return polygons
+    return Polygons.from_contours([contour for obj in contours for polygons in obj for contour in polygons])
 
 
 if __name__ == '__main__':
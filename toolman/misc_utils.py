@@ -2,20 +2,23 @@
 import os
 import time
 import json
-import yaml
 import pickle
+import uuid
+import hashlib
+import queue
+import shutil
 import datetime
-import subprocess
+import threading
+import collections
 import collections.abc
 from glob import glob
-from functools import wraps
+from fnmatch import fnmatch
+from functools import wraps, partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 # Libs
 import numpy as np
-import pandas as pd
-from PIL import Image
 from tqdm import tqdm
-from skimage import io
 from natsort import natsorted
 
 # Own modules
@@ -34,18 +37,137 @@ def make_dir_if_not_exist(dir_path):
         os.makedirs(dir_path)
 
 
+class _ProfileTimer(object):
+    """
+    Time a block of code as a context manager, or every call of a function as a decorator
+    """
+    def __init__(self, profiler, label=None):
+        self.profiler = profiler
+        self.label = label
+        self._start_times = []
+
+    def __enter__(self):
+        if self.profiler.enabled:
+            self._start_times.append(time.perf_counter())
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._start_times:
+            self.profiler.record(self.label, time.perf_counter() - self._start_times.pop())
+
+    def __call__(self, func):
+        label = self.label if self.label is not None else func.__qualname__
+        profiler = self.profiler
+
+        @wraps(func)
+        def profile_wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
+            start_time = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profiler.record(label, time.perf_counter() - start_time)
+        return profile_wrapper
+
+
+class Profiler(object):
+    """
+    Registry of timings by label, use profile() as a decorator or a context manager to record the time.perf_counter
+    durations, nothing is recorded when the profiler is disabled
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._timings = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._timings.clear()
+
+    def record(self, label, duration):
+        """
+        Record one duration of the label
+        :param label: name of the timed code
+        :param duration: duration in seconds
+        :return:
+        """
+        with self._lock:
+            self._timings[label].append(duration)
+
+    def profile(self, label=None):
+        """
+        Time the code by label, e.g.
+            @profiler.profile()
+            def foo(): ...
+            with profiler.profile('load'): ...
+        :param label: name of the timed code, the qualified name of the function will be used if not given
+        :return: object that can be used as decorator or context manager
+        """
+        if label is None or callable(label):
+            func, label = label, None
+            timer = _ProfileTimer(self)
+            return timer(func) if func is not None else timer
+        return _ProfileTimer(self, label)
+
+    def stats(self):
+        """
+        Aggregate the recorded durations of each label
+        :return: dict maps label to dict of count, total, mean, p50, p95 and max in seconds
+        """
+        with self._lock:
+            timings = {k: np.array(v) for k, v in self._timings.items()}
+        return {k: {'count': len(v), 'total': float(np.sum(v)), 'mean': float(np.mean(v)),
+                    'p50': float(np.percentile(v, 50)), 'p95': float(np.percentile(v, 95)), 'max': float(np.max(v))}
+                for k, v in timings.items()}
+
+    def report(self, fmt='table'):
+        """
+        Report the stats sorted by total time
+        :param fmt: 'table' for a text table or 'json' for a json string
+        :return: the report string
+        """
+        stats = self.stats()
+        if fmt == 'json':
+            return json.dumps(stats, sort_keys=True, indent=4)
+        elif fmt != 'table':
+            raise ValueError('fmt {} not understood, should be either table or json'.format(fmt))
+        label_len = max([len(str(a)) for a in stats.keys()] + [5])
+        lines = ['{:<{}} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+            'label', label_len, 'count', 'total(s)', 'mean(s)', 'p50(s)', 'p95(s)', 'max(s)')]
+        for label, v in sorted(stats.items(), key=lambda a: -a[1]['total']):
+            lines.append('{:<{}} {:>8d} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.4f}'.format(
+                str(label), label_len, v['count'], v['total'], v['mean'], v['p50'], v['p95'], v['max']))
+        return '\n'.join(lines)
+
+
+# the default profiler, disabled until profiler.enable() is called
+profiler = Profiler(enabled=False)
+
+
 def timer_decorator(func):
     """
-    This is a decorator to print out running time of executing func
+    This is a decorator to print out running time of executing func, the duration is also recorded by profiler if
+    it is enabled
     :param func:
     :return:
     """
     @wraps(func)
     def timer_wrapper(*args, **kwargs):
-        start_time = time.time()
-        func(*args, **kwargs)
-        duration = time.time() - start_time
-        print('duration: {:.3f}s'.format(duration))
+        start_time = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start_time
+            if profiler.enabled:
+                profiler.record(func.__qualname__, duration)
+            print('duration: {:.3f}s'.format(duration))
     return timer_wrapper
 
 
@@ -62,116 +184,680 @@ def str2list(s, sep=',', d_type=int):
     return s
 
 
-def load_file(file_name, **kwargs):
+# Loader and saver functions of each file extension, the backend libraries are imported the first time the
+# corresponding format is used, see register_format
+_LOADERS = {}
+_SAVERS = {}
+
+
+def register_format(extensions, loader=None, saver=None):
+    """
+    Register the loader and/or saver of the given file extension(s), this will be used by load_file and save_file
+    :param extensions: extension or list of extensions without the leading dot, e.g. 'npy'
+    :param loader: function that loader(file_name, **kwargs) returns the data, should ignore unknown kwargs
+    :param saver: function that saver(file_name, data, **kwargs) saves the data, should ignore unknown kwargs
+    :return:
+    """
+    if isinstance(extensions, str):
+        extensions = [extensions]
+    for ext in extensions:
+        ext = ext.lower().lstrip('.')
+        if loader is not None:
+            _LOADERS[ext] = loader
+        if saver is not None:
+            _SAVERS[ext] = saver
+
+
+def _get_extension(file_name):
     """
-    Read data file of given path, use numpy.load if it is in .npy format,
-    otherwise use pickle or imageio
+    Get the lower case extension of the file without the leading dot
+    :param file_name: the name or path to the file
+    :return: extension of the file
+    """
+    return os.path.splitext(file_name)[1][1:].lower()
+
+
+def _load_npy(file_name, mmap_mode=None, index=None, **kwargs):
+    """
+    Load the .npy file, optionally as a memmap and/or only part of it
     :param file_name: absolute path to the file
-    :return: file data, or IOError if it cannot be read by either numpy or pickle or imageio
+    :param mmap_mode: if not None, the array will be memory-mapped with this mode, see numpy.load
+    :param index: if not None, only data[index] will be read
+    :return: the loaded array
     """
-    try:
-        if file_name[-3:] == 'npy':
-            data = np.load(file_name)
-        elif file_name[-3:] == 'pkl' or file_name[-6:] == 'pickle':
-            with open(file_name, 'rb') as f:
-                data = pickle.load(f)
-        elif file_name[-3:] == 'txt':
-            with open(file_name, 'r') as f:
-                data = f.readlines()
-        elif file_name[-3:] == 'csv':
-            data = pd.read_csv(file_name, **kwargs)
-        elif file_name[-4:] == 'json':
-            data = json.load(open(file_name))
-        elif file_name[-4:] == 'yaml':
-            with open(file_name, 'r') as stream:
-                data = yaml.safe_load(stream)
-        elif 'pil' in kwargs and kwargs['pil']:
-            try:
-                data = Image.open(file_name)
-            except Image.DecompressionBombError:
-                Image.MAX_IMAGE_PIXELS = None
-                data = Image.open(file_name)
-            if 'to_numpy' in kwargs and kwargs['to_numpy']:
-                data = np.array(data)
-        else:
-            try:
-                data = io.imread(file_name)
-            except Image.DecompressionBombError:
-                Image.MAX_IMAGE_PIXELS = None
-                data = io.imread(file_name)
-            except ValueError or OSError:
-                data = np.array(Image.open(file_name))
+    if index is None:
+        return np.load(file_name, mmap_mode=mmap_mode)
+    data = np.load(file_name, mmap_mode=mmap_mode or 'r')[index]
+    if mmap_mode is None:
+        # only copy the selected part into memory
+        data = np.array(data)
+    return data
+
+
+def _load_pickle(file_name, **kwargs):
+    with open(file_name, 'rb') as f:
+        return pickle.load(f)
+
+
+def _load_txt(file_name, **kwargs):
+    with open(file_name, 'r') as f:
+        return f.readlines()
+
 
+def _iter_csv_chunks(reader, to_numpy=False):
+    """
+    Iterate through the chunks of a csv reader, the reader is closed when the iteration stops
+    :param reader: pandas TextFileReader
+    :param to_numpy: if True, each chunk will be converted to numpy array
+    :return: generator of DataFrames or numpy arrays
+    """
+    with reader:
+        for chunk in reader:
+            yield chunk.to_numpy() if to_numpy else chunk
+
+
+def _load_csv(file_name, to_numpy=False, **kwargs):
+    """
+    Load the .csv file with pandas
+    :param file_name: absolute path to the file
+    :param to_numpy: if True, the DataFrame will be converted to numpy array
+    :param kwargs: other parameters used by pd.read_csv, if chunksize is given, a generator of chunks will be returned
+    :return: the loaded DataFrame/array, or a generator of them
+    """
+    import pandas as pd
+    data = pd.read_csv(file_name, **kwargs)
+    if kwargs.get('chunksize', None) is not None:
+        return _iter_csv_chunks(data, to_numpy)
+    return data.to_numpy() if to_numpy else data
+
+
+def _load_json(file_name, **kwargs):
+    with open(file_name, 'r') as f:
+        return json.load(f)
+
+
+def _load_yaml(file_name, **kwargs):
+    import yaml
+    with open(file_name, 'r') as stream:
+        return yaml.safe_load(stream)
+
+
+def _load_image(file_name, pil=False, to_numpy=False, **kwargs):
+    """
+    Load the image with skimage, or PIL if pil=True, this is used for all unregistered extensions
+    :param file_name: absolute path to the file
+    :param pil: if True, the PIL image will be returned
+    :param to_numpy: if True, the PIL image will be converted to numpy array, only works when pil=True
+    :return: the loaded image
+    """
+    from PIL import Image
+    if pil:
+        try:
+            data = Image.open(file_name)
+        except Image.DecompressionBombError:
+            Image.MAX_IMAGE_PIXELS = None
+            data = Image.open(file_name)
+        if to_numpy:
+            data = np.array(data)
         return data
+
+    from skimage import io
+    try:
+        return io.imread(file_name)
+    except Image.DecompressionBombError:
+        Image.MAX_IMAGE_PIXELS = None
+        return io.imread(file_name)
+    except (ValueError, OSError):
+        return np.array(Image.open(file_name))
+
+
+def _save_npy(file_name, data, **kwargs):
+    # write through the file handle as np.save appends .npy to names not ending with it, e.g. upper case extensions
+    with open(file_name, 'wb') as f:
+        np.save(f, data)
+
+
+def _save_pickle(file_name, data, **kwargs):
+    with open(file_name, 'wb') as f:
+        pickle.dump(data, f)
+
+
+def _save_txt(file_name, data, **kwargs):
+    with open(file_name, 'w') as f:
+        f.writelines(data)
+
+
+def _save_csv(file_name, data, fmt='%.8e', header=None, mode='w', chunk_rows=65536, **kwargs):
+    """
+    Save the data to .csv file, DataFrames are saved with pandas, arrays are formatted chunk by chunk with one string
+    formatting per chunk, this gives the same output as np.savetxt but is much faster for large arrays
+    :param file_name: absolute path to the file
+    :param data: DataFrame or array-like with at most 2 dimensions
+    :param fmt: format of each number, a format of the whole row or a list of formats of each column
+    :param header: list of column names, for DataFrames the columns will be used if not given
+    :param mode: 'w' to overwrite or 'a' to append, the header is not written when appending to a non-empty file
+    :param chunk_rows: number of rows formatted at a time
+    :return:
+    """
+    write_header = mode == 'w' or not os.path.exists(file_name) or os.path.getsize(file_name) == 0
+    if hasattr(data, 'to_csv'):
+        if header is None:
+            header = True
+        data.to_csv(file_name, mode=mode, header=header if write_header else False, index=False,
+                    float_format=fmt if isinstance(fmt, str) and fmt.count('%') == 1 else None)
+        return
+
+    data = np.asarray(data)
+    if data.ndim == 1:
+        data = data.reshape(-1, 1)
+    if not isinstance(fmt, str):
+        row_fmt = ','.join(fmt)
+    elif fmt.count('%') == 1:
+        row_fmt = ','.join([fmt] * data.shape[1])
+    else:
+        row_fmt = fmt
+    row_fmt += '\n'
+    with open(file_name, mode) as f:
+        if header is not None and write_header:
+            f.write(','.join(header) + '\n')
+        for start in range(0, data.shape[0], chunk_rows):
+            rows = data[start:start + chunk_rows]
+            f.write((row_fmt * rows.shape[0]) % tuple(rows.ravel().tolist()))
+
+
+def _save_json(file_name, data, sort_keys=True, indent=4, **kwargs):
+    with open(file_name, 'w') as f:
+        json.dump(data, f, sort_keys=sort_keys, indent=indent)
+
+
+def _save_yaml(file_name, data, **kwargs):
+    import yaml
+    with open(file_name, 'w') as stream:
+        yaml.safe_dump(data, stream)
+
+
+def _save_image(file_name, data, **kwargs):
+    from PIL import Image
+    Image.fromarray(data.astype(np.uint8)).save(file_name)
+
+
+register_format('npy', _load_npy, _save_npy)
+register_format(['pkl', 'pickle'], _load_pickle, _save_pickle)
+register_format('txt', _load_txt, _save_txt)
+register_format('csv', _load_csv, _save_csv)
+register_format('json', _load_json, _save_json)
+register_format('yaml', _load_yaml, _save_yaml)
+
+
+# I/O stats of load_file and save_file, see enable_io_stats
+_io_stats_enabled = False
+_io_stats = {}
+_io_stats_lock = threading.Lock()
+
+
+def enable_io_stats(enabled=True):
+    """
+    Enable or disable recording the I/O stats of load_file and save_file
+    :param enabled: if True, the stats will be recorded
+    :return:
+    """
+    global _io_stats_enabled
+    _io_stats_enabled = enabled
+
+
+def reset_io_stats():
+    """
+    Clear the recorded I/O stats
+    """
+    with _io_stats_lock:
+        _io_stats.clear()
+
+
+def io_stats():
+    """
+    Get the I/O stats recorded since enable_io_stats() is called, time of loading includes reading and decoding, and
+    time of saving includes encoding and writing. The bytes are the file sizes, for memory-mapped, partial or chunked
+    reads they are larger than the bytes actually read, and for chunked reads the time only includes opening the file
+    :return: dict maps 'load' and 'save' to dicts that map file extension to dict of calls, bytes, time and errors
+    """
+    with _io_stats_lock:
+        stats = {'load': {}, 'save': {}}
+        for (op, ext), v in _io_stats.items():
+            stats[op][ext] = dict(v)
+        return stats
+
+
+def _record_io(op, ext, file_name, start_time, error=False):
+    """
+    Record one call of load_file or save_file
+    :param op: 'load' or 'save'
+    :param ext: extension of the file
+    :param file_name: path to the file
+    :param start_time: the time.perf_counter() when the call started
+    :param error: if True, the call has failed
+    :return:
+    """
+    duration = time.perf_counter() - start_time
+    try:
+        nbytes = 0 if error else os.path.getsize(file_name)
+    except OSError:
+        nbytes = 0
+    with _io_stats_lock:
+        stats = _io_stats.setdefault((op, ext), {'calls': 0, 'bytes': 0, 'time': 0.0, 'errors': 0})
+        stats['calls'] += 1
+        stats['bytes'] += nbytes
+        stats['time'] += duration
+        stats['errors'] += int(error)
+
+
+def load_file(file_name, cache=None, **kwargs):
+    """
+    Read data file of given path, the loader is chosen by the file extension (see register_format), files with
+    unregistered extensions are read as images by skimage or PIL
+    For .npy files, mmap_mode (e.g. 'r' for a read-only memmap) is passed to numpy.load, and index (a slice, an
+    index array or a tuple of them) only reads the selected part of the array, this is zero-copy for basic slices
+    when mmap_mode is given
+    :param file_name: absolute path to the file
+    :param cache: if True, the data will be read through default_file_cache, or through the given FileCache
+    :param kwargs: other parameters used by the loader, e.g. pd.read_csv parameters for .csv files
+    :return: file data, or IOError if it cannot be read by either numpy or pickle or imageio
+    """
+    if cache:
+        if cache is True:
+            cache = default_file_cache
+        return cache.load(file_name, **kwargs)
+    ext = _get_extension(file_name)
+    loader = _LOADERS.get(ext, _load_image)
+    start_time = time.perf_counter() if _io_stats_enabled else None
+    try:
+        data = loader(file_name, **kwargs)
     except Exception:  # so many things could go wrong, can't be more specific.
+        if start_time is not None:
+            _record_io('load', ext, file_name, start_time, error=True)
         raise IOError('Problem loading {}'.format(file_name))
+    if start_time is not None:
+        _record_io('load', ext, file_name, start_time)
+    return data
+
+
+class FileCache(object):
+    """
+    LRU cache of loaded files with a budget in bytes, an entry is invalid once the mtime or size of the file changes
+    Cached numpy arrays are returned read-only, so that the same copy can be shared by every caller, other objects
+    are shared as well and should not be modified in place
+    """
+    def __init__(self, max_bytes=2**30):
+        """
+        :param max_bytes: the max total size of the cached data in bytes
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_nbytes(data, file_name):
+        """
+        Get the size of the data, use the size of the file if the data is not a numpy array
+        """
+        if isinstance(data, np.ndarray):
+            return data.nbytes
+        return os.path.getsize(file_name)
+
+    @staticmethod
+    def _get_kwargs_key(kwargs):
+        """
+        Get the digest of the kwargs of load_file, the full content of the kwargs is hashed as the repr of large numpy
+        arrays is abbreviated
+        :return: the digest bytes, or None if the kwargs can't be pickled, in which case the data is not cached
+        """
+        try:
+            return hashlib.sha1(pickle.dumps(sorted(kwargs.items()), protocol=4)).digest()
+        except Exception:
+            return None
+
+    def _pop(self, key):
+        _, _, nbytes = self._entries.pop(key)
+        self._total_bytes -= nbytes
 
+    def load(self, file_name, **kwargs):
+        """
+        Load the file from cache if it has not been changed since it's cached, otherwise read it with load_file
+        :param file_name: absolute path to the file
+        :param kwargs: other parameters used by load_file
+        :return: file data
+        """
+        try:
+            stat = os.stat(file_name)
+        except OSError:
+            raise IOError('Problem loading {}'.format(file_name))
+        kwargs_key = self._get_kwargs_key(kwargs)
+        if kwargs_key is None:
+            with self._lock:
+                self.misses += 1
+            return load_file(file_name, **kwargs)
+        key = (os.path.abspath(file_name), kwargs_key)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if key in self._entries:
+                if self._entries[key][0] == signature:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._entries[key][1]
+                self._pop(key)
+            self.misses += 1
+
+        data = load_file(file_name, **kwargs)
+        if isinstance(data, (np.memmap, collections.abc.Iterator)):
+            # memmaps and chunk generators are not read into memory
+            return data
+        if isinstance(data, np.ndarray):
+            data.flags.writeable = False
+        nbytes = self._get_nbytes(data, file_name)
+        if nbytes > self.max_bytes:
+            return data
+
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (signature, data, nbytes)
+            self._total_bytes += nbytes
+            while self._total_bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+        return data
+
+    def clear(self):
+        """
+        Remove all cached data and reset the counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+            self.hits = 0
+            self.misses = 0
 
-def load_files(file_name, **kwargs):
+    def stats(self):
+        """
+        Get the stats of the cache
+        :return: dict of hits, misses, number of entries, total bytes and max bytes
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+                    'bytes': self._total_bytes, 'max_bytes': self.max_bytes}
+
+
+# the cache used by load_file(..., cache=True)
+default_file_cache = FileCache()
+
+
+def _get_executor(workers, backend='thread'):
+    """
+    Get the pool executor for the given backend
+    :param workers: number of workers in the pool
+    :param backend: 'thread' or 'process'
+    :return: the executor instance
     """
-    Load a list of files
+    if backend == 'thread':
+        return ThreadPoolExecutor(max_workers=workers)
+    elif backend == 'process':
+        return ProcessPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError('backend {} not understood, should be either thread or process'.format(backend))
+
+
+def load_files(file_name, workers=None, backend='thread', **kwargs):
+    """
+    Load a list of files, the files will be loaded in parallel if workers is given and the results are returned in
+    the same order as the input list
     :param file_name: could be either the path of one file or list of files
+    :param workers: number of workers used to load the files, if None or 1, the files will be loaded one by one
+    :param backend: 'thread' or 'process', the type of the pool used for loading
+    :param kwargs: other parameters used by load_file
     :return: file data, or IOError if it cannot be read by either numpy or pickle or imageio
     """
     if isinstance(file_name, str):
         return load_file(file_name, **kwargs)
-    elif isinstance(file_name, list) or isinstance(file_name, str):
-        data = []
-        for f in file_name:
-            data.append(load_file(f, **kwargs))
-        return data
+    elif isinstance(file_name, (list, tuple)):
+        if workers is None or workers <= 1:
+            return [load_file(f, **kwargs) for f in file_name]
+        with _get_executor(workers, backend) as executor:
+            return list(executor.map(partial(load_file, **kwargs), file_name))
     else:
         raise TypeError('file_name type {} not understood'.format(type(file_name)))
 
 
-def save_file(file_name, data, fmt='%.8e', sort_keys=True, indent=4):
+def _apply_chunk(func, chunk):
+    """
+    Apply func to each item in a chunk, this is submitted to the pool as one task
+    :param func: the function to apply
+    :param chunk: list of inputs to func
+    :return: list of func(item)
     """
-    Save data file of given path, use numpy.load if it is in .npy format,
-    otherwise use pickle or imageio
+    return [func(item) for item in chunk]
+
+
+def _iter_chunks(items, chunksize):
+    """
+    Group the items into lists of chunksize items lazily
+    :param items: iterable of items
+    :param chunksize: number of items in each chunk, the last chunk could be smaller
+    :return: generator of lists of items
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunksize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _iter_map(func, items, workers=None, backend='thread', prefetch=None, chunksize=1):
+    """
+    Lazily apply func to each item with a pool of workers, at most prefetch items will be processed ahead of the
+    consumer so that the memory usage stays bounded, results are yielded in the same order as the items
+    :param func: the function to apply, should be picklable if backend is process
+    :param items: iterable of inputs to func
+    :param workers: number of workers, if None or 1, the items will be processed one by one in the current thread
+    :param backend: 'thread' or 'process', the type of the pool
+    :param prefetch: max number of pending results, if None, it will be twice the number of workers
+    :param chunksize: number of items submitted to the pool as one task, larger chunks reduce the overhead of
+                      dispatching many small tasks to a process pool, prefetch is counted in chunks
+    :return: generator of func(item)
+    """
+    if workers is None or workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    if chunksize > 1:
+        for chunk in _iter_map(partial(_apply_chunk, func), _iter_chunks(items, chunksize), workers, backend,
+                               prefetch):
+            yield from chunk
+        return
+    if prefetch is None:
+        prefetch = 2 * workers
+    prefetch = max(prefetch, 1)
+    with _get_executor(workers, backend) as executor:
+        pending = collections.deque()
+        try:
+            for item in items:
+                if len(pending) >= prefetch:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(func, item))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # stop loading the files ahead if the consumer stops early or an error is raised
+            for future in pending:
+                future.cancel()
+
+
+def iter_files(file_names, prefetch=None, workers=None, backend='thread', **kwargs):
+    """
+    Iterate through a list of files, the next files are loaded by background workers while the current one is being
+    processed, at most prefetch files are kept in memory ahead of the consumer
+    :param file_names: list of paths to the files
+    :param prefetch: max number of files loaded ahead, if None, it will be twice the number of workers
+    :param workers: number of workers used to load the files, if None or 1, the files will be loaded on demand
+    :param backend: 'thread' or 'process', the type of the pool used for loading
+    :param kwargs: other parameters used by load_file
+    :return: generator of (file_name, data) tuples in the same order as file_names
+    """
+    file_names = list(file_names)
+    data_iter = _iter_map(partial(load_file, **kwargs), file_names, workers, backend, prefetch)
+    for file_name, data in zip(file_names, data_iter):
+        yield file_name, data
+
+
+def save_file(file_name, data, fmt='%.8e', sort_keys=True, indent=4, atomic=False, **kwargs):
+    """
+    Save data file of given path, the saver is chosen by the file extension (see register_format), data with
+    unregistered extensions are saved as images by PIL
     :param file_name: absolute path to the file
     :param data: data to save
+    :param fmt: number format of .csv files
+    :param sort_keys: if True, the keys of .json files will be sorted
+    :param indent: indent of .json files
+    :param atomic: if True, the data will be written to a temporary file first and then renamed to file_name, so that
+                   readers never see a partially written file
+    :param kwargs: other parameters used by the saver
     :return: file data, or IOError if it cannot be saved by either numpy or or pickle imageio
     """
+    ext = _get_extension(file_name)
+    saver = _SAVERS.get(ext, _save_image)
+    start_time = time.perf_counter() if _io_stats_enabled else None
     try:
-        if file_name[-3:] == 'npy':
-            np.save(file_name, data)
-        elif file_name[-3:] == 'pkl':
-            with open(file_name, 'wb') as f:
-                pickle.dump(data, f)
-        elif file_name[-3:] == 'txt':
-            with open(file_name, 'w') as f:
-                f.writelines(data)
-        elif file_name[-3:] == 'csv':
-            np.savetxt(file_name, data, delimiter=',', fmt=fmt)
-        elif file_name[-4:] == 'json':
-            json.dump(data, open(file_name, 'w'), sort_keys=sort_keys, indent=indent)
-        elif file_name[-4:] == 'yaml':
-            with open(file_name, 'w') as stream:
-                yaml.safe_dump(data, stream)
+        if atomic:
+            # keep the extension as some savers depend on it
+            root, suffix = os.path.splitext(file_name)
+            temp_name = '{}.tmp-{}{}'.format(root, uuid.uuid4().hex[:8], suffix)
+            try:
+                saver(temp_name, data, fmt=fmt, sort_keys=sort_keys, indent=indent, **kwargs)
+                os.replace(temp_name, file_name)
+            finally:
+                if os.path.exists(temp_name):
+                    os.remove(temp_name)
         else:
-            data = Image.fromarray(data.astype(np.uint8))
-            data.save(file_name)
+            saver(file_name, data, fmt=fmt, sort_keys=sort_keys, indent=indent, **kwargs)
     except Exception:  # so many things could go wrong, can't be more specific.
-        raise IOError('Problem saving this data')
+        if start_time is not None:
+            _record_io('save', ext, file_name, start_time, error=True)
+        raise IOError('Problem saving {}'.format(file_name))
+    if start_time is not None:
+        _record_io('save', ext, file_name, start_time)
 
 
-def save_files(file_name, data, fmt='%.8e', sort_keys=True, indent=4):
+def save_files(file_name, data, fmt='%.8e', sort_keys=True, indent=4, workers=None, **kwargs):
     """
     Save a list of files
     :param file_name: could be either the path of one file or list of files
-    :return: file data, or IOError if it cannot be read by either numpy or pickle or imageio
+    :param data: the data to save, should be a list with the same length as file_name if file_name is a list
+    :param workers: number of threads used to save the files, if None or 1, the files will be saved one by one
+    :param kwargs: other parameters used by save_file
+    :return: IOError if any of the files cannot be saved
     """
     if isinstance(file_name, str):
-        return save_file(file_name, data, fmt, sort_keys, indent)
-    elif isinstance(file_name, list) or isinstance(file_name, str):
-        data = []
-        for f in file_name:
-            data.append(save_file(f, data, fmt, sort_keys, indent))
-        return data
+        return save_file(file_name, data, fmt, sort_keys, indent, **kwargs)
+    elif isinstance(file_name, (list, tuple)):
+        if len(file_name) != len(data):
+            raise ValueError('Number of files {} does not match the number of data {}'.format(
+                len(file_name), len(data)))
+        save_func = partial(save_file, fmt=fmt, sort_keys=sort_keys, indent=indent, **kwargs)
+        if workers is None or workers <= 1:
+            for f, d in zip(file_name, data):
+                save_func(f, d)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(save_func, file_name, data))
     else:
         raise TypeError('file_name type {} not understood'.format(type(file_name)))
 
 
+class AsyncWriter(object):
+    """
+    Save files with background threads, write() returns as soon as the data is queued so that the caller can keep
+    computing, files are written atomically with save_file(..., atomic=True)
+    The queued data is not copied, it should not be modified after calling write()
+    Errors of the background writes are raised as IOError by the next write(), flush() or close()
+    """
+    def __init__(self, workers=1, max_queue=16, **kwargs):
+        """
+        :param workers: number of writer threads
+        :param max_queue: max number of queued files, write() blocks when the queue is full
+        :param kwargs: other parameters used by save_file
+        """
+        self.kwargs = kwargs
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._errors = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(workers)]
+        for t in self._threads:
+            t.start()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                file_name, data, kwargs = item
+                save_file(file_name, data, atomic=True, **kwargs)
+            except Exception as e:
+                with self._lock:
+                    self._errors.append((file_name, e))
+            finally:
+                self._queue.task_done()
+
+    def _raise_errors(self):
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise IOError('Problem saving {}'.format(', '.join(f for f, _ in errors))) from errors[0][1]
+
+    def write(self, file_name, data, **kwargs):
+        """
+        Queue the data to be saved
+        :param file_name: absolute path to the file
+        :param data: data to save
+        :param kwargs: other parameters used by save_file, will override the ones given in __init__
+        :return:
+        """
+        if self._closed:
+            raise ValueError('Write to a closed AsyncWriter')
+        self._raise_errors()
+        self._queue.put((file_name, data, dict(self.kwargs, **kwargs)))
+
+    def flush(self):
+        """
+        Wait until all queued files are written
+        """
+        self._queue.join()
+        self._raise_errors()
+
+    def close(self):
+        """
+        Write all queued files and stop the writer threads
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._raise_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 def rotate_list(l):
     """
     Rotate a list of lists
@@ -266,16 +952,126 @@ def get_file_name_no_extension(file_name):
     return os.path.splitext(os.path.basename(file_name))[0]
 
 
-def get_files(path_list, extension):
+def _scan_dirs(root_dir, index, max_depth=None):
+    """
+    List all files under root_dir with os.scandir, directories whose mtime has not changed since they are recorded in
+    the index are not listed again
+    :param root_dir: the directory to list
+    :param index: dict maps directory path to its mtime, files as (name, size, mtime) and sub-directory names, will be
+                  updated in place
+    :param max_depth: max depth of the sub-directories to list, 0 means only root_dir, if None, all sub-directories
+                      will be listed
+    :return: list of (path, size, mtime) of the files, list of paths of the sub-directories, and whether the index
+             has been updated
+    """
+    files, dirs = [], []
+    updated = False
+    visited = set()
+    stack = [(root_dir, 0)]
+    while stack:
+        dir_path, depth = stack.pop()
+        visited.add(dir_path)
+        dir_mtime = os.stat(dir_path).st_mtime_ns
+        entry = index.get(dir_path, None)
+        if entry is None or entry['mtime'] != dir_mtime:
+            dir_files, dir_names = [], []
+            with os.scandir(dir_path) as it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        dir_names.append(e.name)
+                    elif e.is_file():
+                        stat = e.stat()
+                        dir_files.append((e.name, stat.st_size, stat.st_mtime_ns))
+            # changes within the timestamp resolution may not update the mtime, so recently modified directories
+            # will be listed again next time
+            if time.time_ns() - dir_mtime < 2e9:
+                dir_mtime = None
+            entry = {'mtime': dir_mtime, 'files': dir_files, 'dirs': dir_names}
+            index[dir_path] = entry
+            updated = True
+        files.extend((os.path.join(dir_path, name), size, mtime) for name, size, mtime in entry['files'])
+        dirs.extend(os.path.join(dir_path, name) for name in entry['dirs'])
+        if max_depth is None or depth < max_depth:
+            stack.extend((os.path.join(dir_path, name), depth + 1) for name in entry['dirs'])
+
+    # remove directories within the listed depth that no longer exist
+    for dir_path in list(index.keys()):
+        if dir_path in visited or not (dir_path + os.sep).startswith(os.path.join(root_dir, '')):
+            continue
+        depth = 0 if dir_path == root_dir else os.path.relpath(dir_path, root_dir).count(os.sep) + 1
+        if max_depth is None or depth <= max_depth:
+            index.pop(dir_path)
+            updated = True
+    return files, dirs, updated
+
+
+def _match_parts(parts, patterns):
+    """
+    Match the components of a path with the components of a pattern like glob does, names starting with a dot are
+    only matched by patterns starting with a dot
+    :param parts: list of path components
+    :param patterns: list of pattern components
+    :return: True if every component matches
+    """
+    return len(parts) == len(patterns) and all(
+        fnmatch(part, pattern) and (pattern.startswith('.') or not part.startswith('.'))
+        for part, pattern in zip(parts, patterns))
+
+
+def get_files(path_list, extension, recursive=False, index_file=None):
     """
     Get files in the given folder that matches certain regex
-    :param path_list: list of path to the directory
-    :param extension: regex that filters the desired files
-    :return: list of files
+    :param path_list: list of path to the directory, could contain wildcards like glob
+    :param extension: regex that filters the desired files, or a list of them, e.g. ['*.png', '*.jpg', 'a/*.png']
+    :param recursive: if True, files in all sub-directories will be included as well, the patterns are then matched
+                      against the last components of the paths, e.g. 'a/*.png' matches png files in any directory
+                      named a under path_list
+    :param index_file: if given, the (path, size, mtime) of the listed files will be stored in this .pkl file, and
+                       only the directories modified since the last call will be listed again, the results are the
+                       same as without the index
+    :return: list of files, like glob, directories matching the patterns are included unless recursive is True
     """
     if isinstance(path_list, str):
         path_list = [path_list]
-    return natsorted(glob(os.path.join(*path_list, extension)))
+    if isinstance(extension, str):
+        extension = [extension]
+    if not recursive and index_file is None:
+        files = set()
+        for ext in extension:
+            files.update(glob(os.path.join(*path_list, ext)))
+        return natsorted(files)
+
+    # the directories are listed from the longest prefix without wildcards, the rest of path_list is matched as part
+    # of the patterns, the results keep the same prefix as the given path like glob does
+    parts = os.path.join(*path_list).split(os.sep)
+    literal_num = next((cnt for cnt, part in enumerate(parts) if any(c in part for c in '*?[')), len(parts))
+    prefix = os.sep.join(parts[:literal_num]) or (os.sep if literal_num > 0 else '')
+    dir_patterns = [a for a in parts[literal_num:] if a]
+    ext_patterns = [[a for a in ext.split(os.sep) if a] for ext in extension]
+    root_dir = os.path.abspath(prefix or os.curdir)
+    if not os.path.isdir(root_dir):
+        return []
+
+    max_depth = None if recursive else max(len(dir_patterns) + len(a) for a in ext_patterns) - 1
+    # the index is keyed by absolute paths
+    index = load_file(index_file) if index_file is not None and os.path.exists(index_file) else {}
+    files, dirs, updated = _scan_dirs(root_dir, index, max_depth)
+    if index_file is not None and updated:
+        save_file(index_file, index, atomic=True)
+
+    def match(rel_parts):
+        if not recursive:
+            return any(_match_parts(rel_parts, dir_patterns + a) for a in ext_patterns)
+        dir_num = len(dir_patterns)
+        return _match_parts(rel_parts[:dir_num], dir_patterns) and \
+            any(len(rel_parts) - dir_num >= len(a) and _match_parts(rel_parts[len(rel_parts) - len(a):], a)
+                for a in ext_patterns)
+
+    # directories are matched as well like glob does, except in recursive mode
+    rel_paths = [os.path.relpath(f, root_dir) for f, _, _ in files]
+    if not recursive:
+        rel_paths += [os.path.relpath(d, root_dir) for d in dirs]
+    return natsorted(os.path.join(prefix, rel) for rel in rel_paths if match(rel.split(os.sep)))
 
 
 def recursive_update(d, u):
@@ -333,13 +1129,34 @@ def verb_print(txt, verbose=True):
         print(txt)
 
 
-def get_file_length(file_name):
+def _count_lines(file_name, buffer_size=2**20):
     """
-    Get the file length, this would be useful to know the total length for tqdm when processing large file
+    Count the number of newline characters in the file, same as `wc -l`
     :param file_name: the path to the file
-    :return:
+    :param buffer_size: number of bytes read at a time
+    :return: number of lines
+    """
+    cnt = 0
+    buffer = bytearray(buffer_size)
+    with open(file_name, 'rb', buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            cnt += buffer.count(b'\n', 0, size)
+    return cnt
+
+
+def get_file_length(file_name, workers=None):
+    """
+    Get the file length, this would be useful to know the total length for tqdm when processing large file
+    :param file_name: the path to the file or a list of paths
+    :param workers: number of threads used to count the lines of a list of files
+    :return: number of lines in the file, or a list of them if file_name is a list
     """
-    return int(subprocess.check_output('wc -l {}'.format(file_name), shell=True).split()[0])
+    if isinstance(file_name, (str, os.PathLike)):
+        return _count_lines(file_name)
+    return list(_iter_map(_count_lines, file_name, workers))
 
 
 def get_time_str(time_fmt='%Y-%m-%d_%H-%M-%S'):
@@ -351,43 +1168,159 @@ def get_time_str(time_fmt='%Y-%m-%d_%H-%M-%S'):
     return datetime.datetime.now().strftime(time_fmt)
 
 
-def random_split(array, portions, seed=None):
+def _split_sizes(portions, n):
+    """
+    Get the cumulative right bounds of each portion of n elements, the rest elements are in the last portion
     """
-    Randomly split an array into given portions
-    :param array: an iterable object, will be splitted into different portions
-    :param portions: a list of portions, should be summed to 1, otherwise the last element will be the rest elements
+    bounds = np.cumsum(np.floor(np.array(portions) * n).astype(np.int64))
+    bounds[-1] = n
+    return bounds
+
+
+def _encode_labels(values):
+    """
+    Encode the labels into consecutive ids, non-negative integer labels are used as ids directly to avoid sorting
+    :param values: array-like labels
+    :return: ids of each element and the number of elements of each id
+    """
+    values = np.asarray(values).reshape(-1)
+    if values.dtype.kind in 'iub' and len(values) > 0 and values.min() >= 0 and values.max() <= len(values):
+        ids = values.astype(np.int64, copy=False)
+        counts = np.bincount(ids)
+    else:
+        _, ids, counts = np.unique(values, return_inverse=True, return_counts=True)
+        ids = ids.reshape(-1)
+    # smaller integer types let numpy use radix sort
+    if len(counts) <= np.iinfo(np.uint16).max:
+        ids = ids.astype(np.uint16)
+    return ids, counts
+
+
+def random_split(array, portions, seed=None, stratify=None, groups=None, return_indices=False):
+    """
+    Randomly split an array into given portions, a local random generator is used so the global numpy random state is
+    not affected
+    :param array: an iterable object, will be splitted into different portions, numpy arrays (including memmaps) and
+                  pandas objects are indexed at once, other sequences are indexed element by element
+    :param portions: a list of portions, should be summed to 1, otherwise the last element will be the rest elements,
+                     each split gets the floor of its portion and the elements left by the rounding are in the last
+                     split, except for stratified splits, where they are spread over the splits, see stratify
     :param seed: if given, the seed will be set, this is for reproducibility
-    :return:
+    :param stratify: if given, the labels of each element, each portion will be taken from every label separately so
+                     that the label distribution is kept in each split, the number of elements of each label in a
+                     split differs from its exact portion by less than one
+    :param groups: if given, the group of each element, elements of the same group will be in the same split, the
+                   portions are then the approximated fractions of elements
+    :param return_indices: if True, the indices of each split will be returned instead of the elements
+    :return: list of splits
     """
-    if seed is not None:
-        np.random.seed(seed)
     if np.sum(portions) < 1 and np.sum(portions) > 0:
         portions = list(portions)
         portions.append(1 - np.sum(portions))
     elif np.sum(portions) > 1 or np.sum(portions) < 0:
         raise ValueError
+    if stratify is not None and groups is not None:
+        raise ValueError('stratify and groups can not be used together')
 
+    rng = np.random.default_rng(seed)
     array_len = len(array)
-    rand_idx = np.random.permutation(np.arange(array_len))
-    portions = [int(np.floor(a * array_len)) for a in portions]
-    for cnt in range(1, len(portions)):
-        portions[cnt] = portions[cnt-1] + portions[cnt]
+    if stratify is not None:
+        # sort the random order by label, then split the segment of every label by its cumulative bounds, which are
+        # rounded with an offset per label, the offsets are evenly spaced in [0, 1) and shuffled so that the
+        # remainders of the labels are spread over the splits in proportion to the portions and no element is dropped
+        rand_idx = rng.permutation(array_len)
+        labels, counts = _encode_labels(stratify)
+        order = np.argsort(labels[rand_idx], kind='stable')
+        offsets = (rng.permutation(len(counts)) + rng.random()) / len(counts)
+        bounds = np.floor(np.cumsum(portions)[None, :] * counts[:, None] + offsets[:, None]).astype(np.int64)
+        bounds = np.minimum(bounds, counts[:, None])
+        bounds[:, -1] = counts
+        bounds = np.concatenate([np.zeros((len(counts), 1), dtype=np.int64), bounds], axis=1)
+        split_ids = np.empty(array_len, dtype=np.int64)
+        split_ids[order] = np.repeat(np.tile(np.arange(len(portions)), len(counts)), np.diff(bounds).ravel())
+        split_idx = [rand_idx[split_ids == cnt] for cnt in range(len(portions))]
+    elif groups is not None:
+        # assign the groups in random order by where the middle of each group falls
+        group_ids, counts = _encode_labels(groups)
+        group_order = rng.permutation(len(counts))
+        middles = np.cumsum(counts[group_order]) - counts[group_order] / 2
+        group_splits = np.empty(len(counts), dtype=np.int64)
+        group_splits[group_order] = np.minimum(
+            np.searchsorted(_split_sizes(portions, array_len), middles, side='right'), len(portions) - 1)
+        split_ids = group_splits[group_ids]
+        split_idx = [rng.permutation(np.flatnonzero(split_ids == cnt)) for cnt in range(len(portions))]
+    else:
+        rand_idx = rng.permutation(array_len)
+        bounds = np.concatenate([[0], _split_sizes(portions, array_len)])
+        split_idx = [rand_idx[lb:rb] for lb, rb in zip(bounds[:-1], bounds[1:])]
+
+    if return_indices:
+        return split_idx
+    if isinstance(array, np.ndarray):
+        return [array[idx] for idx in split_idx]
+    if hasattr(array, 'iloc'):
+        return [array.iloc[idx] for idx in split_idx]
+    return [[array[a] for a in idx.tolist()] for idx in split_idx]
+
+
+def _create_link(source_file, target_file, mode='symlink', overwrite=False, relative=False):
+    """
+    Create one link of the source file, existing targets are replaced atomically if overwrite is True
+    :return: 'created', 'skipped' or the error message
+    """
+    try:
+        exists = os.path.lexists(target_file)
+        if exists and not overwrite:
+            return 'skipped'
+        temp_file = '{}.tmp-{}'.format(target_file, uuid.uuid4().hex[:8]) if exists else target_file
+        if mode == 'symlink':
+            if relative:
+                source_file = os.path.relpath(source_file, os.path.dirname(os.path.abspath(target_file)))
+            os.symlink(source_file, temp_file)
+        elif mode == 'hardlink':
+            os.link(source_file, temp_file)
+        else:
+            shutil.copy2(source_file, temp_file)
+        if exists:
+            os.replace(temp_file, target_file)
+            # renaming a hard link onto another link of the same file does nothing
+            if os.path.lexists(temp_file):
+                os.remove(temp_file)
+        return 'created'
+    except OSError as e:
+        return str(e)
 
-    splits = [[array[a] for a in rand_idx[:portions[0]]]]
-    for lb, rb in zip(portions[:-1], portions[1:]):
-        splits.append([array[a] for a in rand_idx[lb:rb]])
 
-    return splits
+def _create_link_pair(pair, **kwargs):
+    return _create_link(*pair, **kwargs)
 
 
-def create_symlinks(source_files, dest_dir):
+def create_symlinks(source_files, dest_dir, mode='symlink', overwrite=False, relative=False, workers=8,
+                    verbose=True):
     """
-    Create symbolic links of certain files in another directory
+    Create symbolic links of certain files in another directory, existing targets are skipped or overwritten so that
+    it is safe to run again
     :param source_files: absolute path of the files
     :param dest_dir: destination of the folder to have the symbolic links
-
-    :return:
+    :param mode: 'symlink', 'hardlink' or 'copy'
+    :param overwrite: if True, existing targets will be replaced, otherwise they will be skipped
+    :param relative: if True, the symbolic links will point to the relative paths of the source files
+    :param workers: number of threads used to create the links
+    :param verbose: if True, the progress bar will be displayed
+    :return: dict of the number of created and skipped links, and list of (source file, error message) that failed
     """
-    for source_file in tqdm(source_files):
-        target_file = os.path.join(dest_dir, os.path.basename(source_file))
-        os.symlink(source_file, target_file)
+    if mode not in ['symlink', 'hardlink', 'copy']:
+        raise ValueError('mode {} not understood, should be one of symlink, hardlink or copy'.format(mode))
+    make_dir_if_not_exist(dest_dir)
+    source_files = list(source_files)
+    link_func = partial(_create_link_pair, mode=mode, overwrite=overwrite, relative=relative)
+    pairs = [(f, os.path.join(dest_dir, os.path.basename(f))) for f in source_files]
+
+    summary = {'created': 0, 'skipped': 0, 'failed': []}
+    for source_file, result in tqdm(zip(source_files, _iter_map(link_func, pairs, workers)),
+                                    total=len(source_files), disable=not verbose):
+        if result in ('created', 'skipped'):
+            summary[result] += 1
+        else:
+            summary['failed'].append((source_file, result))
+    return summary
@@ -12,17 +12,459 @@
 
 # Built-in
 import os
+import re
+import sys
+import json
+import uuid
+import gzip
+import mmap
+import time
+import socket
+import struct
+import shutil
+import pickle
+import inspect
+import hashlib
+import threading
+import itertools
+import collections
+from functools import partial
+from concurrent.futures import wait, FIRST_COMPLETED
 
 # Libraries
+import numpy as np
 
 # Custom
-from .misc_utils import load_file, save_file, make_dir_if_not_exist, verb_print
+from .misc_utils import load_file, save_file, make_dir_if_not_exist, verb_print, _get_executor, _iter_map
 
 # Settings
+KEY_LEN = 16
+HASH_CHUNK_BYTES = 2 ** 24
+
+
+def _update_hash(hasher, obj):
+    """
+    Recursively feed a canonical representation of obj into hasher, dicts and sets are hashed regardless of their
+    order and numpy arrays are hashed by their dtype, shape and content, so that the hash is the same across
+    interpreters
+    :param hasher: the hashlib object to be updated
+    :param obj: the object to be hashed
+    :return:
+    """
+    hasher.update(type(obj).__name__.encode())
+    if isinstance(obj, dict):
+        for k, v in sorted(obj.items(), key=lambda a: repr(a[0])):
+            _update_hash(hasher, k)
+            _update_hash(hasher, v)
+    elif isinstance(obj, (list, tuple)):
+        hasher.update(str(len(obj)).encode())
+        for v in obj:
+            _update_hash(hasher, v)
+    elif isinstance(obj, (set, frozenset)):
+        # the iteration order of sets depends on PYTHONHASHSEED, hash the sorted hashes of the elements instead
+        hasher.update(str(len(obj)).encode())
+        for digest in sorted(_get_hash(v) for v in obj):
+            hasher.update(digest)
+    elif isinstance(obj, np.ndarray):
+        hasher.update('{}{}'.format(obj.dtype.str, obj.shape).encode())
+        if obj.ndim == 0 or obj.size == 0 or obj.dtype.hasobject:
+            hasher.update(np.ascontiguousarray(obj).tobytes())
+            return
+        # feed the content in chunks so that large arrays and memmaps are never copied into memory as a whole
+        step = max(1, HASH_CHUNK_BYTES // max(obj[0].nbytes, 1))
+        for start in range(0, len(obj), step):
+            hasher.update(memoryview(np.ascontiguousarray(obj[start:start + step]).reshape(-1).view(np.uint8)))
+    elif obj is None or isinstance(obj, (str, bytes, int, float, complex, np.generic)):
+        hasher.update(repr(obj).encode())
+    elif callable(obj) and hasattr(obj, '__code__'):
+        _update_hash(hasher, _get_func_code(obj))
+    else:
+        try:
+            hasher.update(pickle.dumps(obj, protocol=4))
+        except Exception as e:
+            # the repr of such objects usually contains its memory address, which changes in every process
+            raise TypeError('Cannot hash parameter of type {}, it should be picklable'.format(
+                type(obj).__name__)) from e
+
+
+def _get_hash(obj):
+    """
+    Get the digest of obj with _update_hash
+    :param obj: the object to be hashed
+    :return: the sha1 digest bytes
+    """
+    hasher = hashlib.sha1()
+    _update_hash(hasher, obj)
+    return hasher.digest()
+
+
+def _get_func_code(func):
+    """
+    Get the source code of the function, or its bytecode and constants if the source is not available
+    :param func: the function to be inspected
+    :return: string or bytes that changes when the function is changed
+    """
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        code = getattr(func, '__code__', None)
+        if code is None:
+            return repr(func)
+        return code.co_code + repr(code.co_consts).encode()
+
+
+def _save_pickle5(file_name, data):
+    """
+    Save the data with pickle protocol 5, large buffers like numpy arrays are written out-of-band after the pickle
+    stream, aligned to 64 bytes, so that they can be memory-mapped when loading, this requires python 3.8
+    """
+    buffers = []
+    payload = pickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+    with open(file_name, 'wb') as f:
+        f.write(struct.pack('<QQ', len(payload), len(buffers)))
+        f.write(payload)
+        for buffer in buffers:
+            raw = buffer.raw()
+            f.write(struct.pack('<Q', raw.nbytes))
+            f.write(b'\0' * (-f.tell() % 64))
+            f.write(raw)
+
+
+def _load_pickle5(file_name):
+    """
+    Load the data saved by _save_pickle5, the out-of-band buffers are memory-mapped read-only instead of read
+    """
+    with open(file_name, 'rb') as f:
+        payload_len, buffer_num = struct.unpack('<QQ', f.read(16))
+        payload = f.read(payload_len)
+        if buffer_num == 0:
+            return pickle.loads(payload)
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    buffers = []
+    offset = 16 + payload_len
+    for _ in range(buffer_num):
+        nbytes = struct.unpack('<Q', view[offset:offset + 8])[0]
+        offset += 8 + (-(offset + 8) % 64)
+        buffers.append(view[offset:offset + nbytes])
+        offset += nbytes
+    return pickle.loads(payload, buffers=buffers)
+
+
+def _save_pickle_gz(file_name, data):
+    with gzip.open(file_name, 'wb', compresslevel=6) as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load_pickle_gz(file_name):
+    with gzip.open(file_name, 'rb') as f:
+        return pickle.load(f)
+
+
+def _save_npz(file_name, data):
+    np.savez_compressed(file_name, data=data)
+
+
+def _load_npz(file_name):
+    with np.load(file_name) as f:
+        return f['data']
+
+
+# Serializers of the results of ProcessBlock, maps the name to the file extension, save and load functions
+SERIALIZERS = collections.OrderedDict([
+    ('pkl', ('pkl', save_file, load_file)),
+    ('npy', ('npy', save_file, partial(load_file, mmap_mode='r'))),
+    ('pkl.gz', ('pkl.gz', _save_pickle_gz, _load_pickle_gz)),
+    ('npz', ('npz', _save_npz, _load_npz)),
+])
+# pickle protocol 5 with out-of-band buffers is only available since python 3.8
+if sys.version_info >= (3, 8):
+    SERIALIZERS['pkl5'] = ('pkl5', _save_pickle5, _load_pickle5)
+
+
+# Serializers that only save numpy arrays without objects
+ARRAY_SERIALIZERS = {'npy', 'npz'}
+
+
+def register_serializer(name, extension, saver, loader):
+    """
+    Register a serializer that can be used by ProcessBlock
+    :param name: name of the serializer
+    :param extension: extension of the result files without the leading dot
+    :param saver: function that saver(file_name, data) saves the data
+    :param loader: function that loader(file_name) returns the data
+    :return:
+    """
+    SERIALIZERS[name] = (extension, saver, loader)
+
+
+def detect_serializer(data):
+    """
+    Choose the serializer by the type of the data, numpy arrays are saved as .npy so that they can be memory-mapped,
+    other data are pickled
+    :param data: the data to be saved
+    :return: name of the serializer
+    """
+    if isinstance(data, np.ndarray) and not data.dtype.hasobject:
+        return 'npy'
+    return 'pkl'
+
+
+def _pid_alive(pid):
+    """
+    Check if the process of the pid is running on this host
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class FileLock(object):
+    """
+    Exclusive lock across processes and nodes on a shared file system, the lock file is created atomically with
+    os.link and records the pid, hostname and a unique token of the owner, a heartbeat thread keeps updating its mtime
+    while the lock is held
+    A lock is considered stale and will be broken if its owner is no longer running on this host, or if its heartbeat
+    is older than stale_timeout, which assumes the clocks of the nodes are roughly in sync
+    The lock file is only removed while holding a short-lived mutex file, after checking that it still has the token
+    of its owner, or the token and mtime that were judged stale, so a waiter never removes the lock that another
+    waiter has just acquired
+    The mutex is created the same way with a token, a mutex left by a process that died while holding it is broken
+    after stale_timeout by renaming it away first and checking its token and mtime, a fresh mutex renamed by mistake
+    is put back. Only if yet another waiter creates the mutex in the moment it is renamed away, two waiters could hold
+    it at the same time, which requires a process to die within the few microseconds the mutex is held
+    """
+    def __init__(self, lock_file, stale_timeout=60, heartbeat_interval=None, poll_interval=0.5):
+        """
+        :param lock_file: path to the lock file
+        :param stale_timeout: seconds without heartbeat after which the lock is considered stale
+        :param heartbeat_interval: seconds between heartbeats, a quarter of stale_timeout if not given
+        :param poll_interval: seconds between attempts to acquire the lock
+        """
+        self.lock_file = lock_file
+        self.stale_timeout = stale_timeout
+        self.heartbeat_interval = heartbeat_interval if heartbeat_interval is not None else stale_timeout / 4
+        self.poll_interval = poll_interval
+        self._token = None
+        self._stop_event = None
+        self._heartbeat_thread = None
+
+    def _read_owner(self, file_name=None):
+        """
+        Read the owner of the lock and the mtime of the lock file from the same open file
+        :param file_name: the file to read, the lock file if not given
+        :return: dict of the pid, host and token of the owner and the mtime, or None if there is no lock
+        """
+        try:
+            with open(file_name or self.lock_file, 'r') as f:
+                owner = json.load(f)
+                owner['mtime'] = os.fstat(f.fileno()).st_mtime
+            return owner
+        except (OSError, ValueError):
+            return None
+
+    def _get_stale_owner(self):
+        """
+        Get the owner of the lock if the lock is stale
+        :return: the owner returned by _read_owner, or None if the lock is not stale
+        """
+        owner = self._read_owner()
+        if owner is None:
+            return None
+        if time.time() - owner['mtime'] > self.stale_timeout:
+            return owner
+        if owner['host'] == socket.gethostname() and not _pid_alive(owner['pid']):
+            return owner
+        return None
+
+    def _create(self, file_name, token):
+        """
+        Write the owner info with the token to a private file and link it to file_name, so file_name is never seen
+        without the owner info
+        :param file_name: the file to create
+        :param token: the token of the owner
+        :return: True if file_name is created, False if it already exists
+        """
+        owner_file = '{}.{}'.format(file_name, token)
+        with open(owner_file, 'w') as f:
+            json.dump({'pid': os.getpid(), 'host': socket.gethostname(), 'time': time.time(), 'token': token}, f)
+        try:
+            os.link(owner_file, file_name)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(owner_file)
+
+    def _break(self, file_name, stale_owner):
+        """
+        Remove file_name if it still has the token and mtime that were judged stale, it is renamed away first so that
+        the check and the removal act on the same file, if it turns out to be a fresh one, it is put back
+        :param file_name: the file to break
+        :param stale_owner: the owner returned by _read_owner when the file was judged stale
+        :return:
+        """
+        broken_file = '{}.broken-{}'.format(file_name, uuid.uuid4().hex)
+        try:
+            os.rename(file_name, broken_file)
+        except OSError:
+            return
+        owner = self._read_owner(broken_file)
+        if owner is None or (owner.get('token'), owner['mtime']) != (stale_owner.get('token'), stale_owner['mtime']):
+            try:
+                os.link(broken_file, file_name)
+            except OSError:
+                pass
+        os.remove(broken_file)
+
+    def _acquire_mutex(self):
+        """
+        Acquire the mutex that is held while checking and removing the lock file
+        :return: path to the mutex file and its token
+        """
+        mutex_file = '{}.mutex'.format(self.lock_file)
+        token = uuid.uuid4().hex
+        while not self._create(mutex_file, token):
+            # the mutex is only held for a moment, its holder has died if it is older than stale_timeout
+            owner = self._read_owner(mutex_file)
+            if owner is not None and time.time() - owner['mtime'] > self.stale_timeout:
+                self._break(mutex_file, owner)
+            else:
+                time.sleep(min(self.poll_interval, 0.01))
+        return mutex_file, token
+
+    def _release_mutex(self, mutex_file, token):
+        owner = self._read_owner(mutex_file)
+        if owner is not None and owner.get('token') == token:
+            os.remove(mutex_file)
+
+    def _remove(self, token, mtime=None):
+        """
+        Remove the lock file if it still has the given token, and the given mtime if it's not None
+        :param token: the token of the owner
+        :param mtime: the mtime of the lock file when it was judged stale
+        :return: True if the lock file is removed
+        """
+        mutex_file, mutex_token = self._acquire_mutex()
+        try:
+            owner = self._read_owner()
+            if owner is None or owner.get('token') != token or (mtime is not None and owner['mtime'] != mtime):
+                return False
+            os.remove(self.lock_file)
+            return True
+        finally:
+            self._release_mutex(mutex_file, mutex_token)
+
+    def _heartbeat(self):
+        while not self._stop_event.wait(self.heartbeat_interval):
+            try:
+                with open(self.lock_file, 'r') as f:
+                    # only touch the lock if it is still ours, the opened file is touched so it can't be swapped
+                    if json.load(f).get('token') == self._token:
+                        os.utime(f.fileno() if os.utime in os.supports_fd else self.lock_file)
+            except (OSError, ValueError):
+                pass
+
+    def acquire(self):
+        """
+        Wait until the lock is acquired
+        :return: True if it had to wait for another owner
+        """
+        token = uuid.uuid4().hex
+        waited = False
+        # the owner info is written again at every attempt, so the lock file has a fresh mtime once it is created
+        while not self._create(self.lock_file, token):
+            owner = self._get_stale_owner()
+            if owner is not None:
+                self._remove(owner.get('token'), owner['mtime'])
+            else:
+                waited = True
+                time.sleep(self.poll_interval)
+        self._token = token
+        self._stop_event = threading.Event()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._heartbeat_thread.start()
+        return waited
+
+    def release(self):
+        """
+        Release the lock, the lock file is left untouched if it has been broken and acquired by another owner
+        """
+        if self._heartbeat_thread is not None:
+            self._stop_event.set()
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+        if self._token is not None:
+            self._remove(self._token)
+            self._token = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class ChunkedResult(object):
+    """
+    Result of a generator ProcessBlock, a lazy sequence of the saved chunks, each chunk is loaded when accessed
+    """
+    def __init__(self, chunk_dir, chunks):
+        """
+        :param chunk_dir: the directory of the chunk files
+        :param chunks: list of (file name, serializer name) of each chunk
+        """
+        self.chunk_dir = chunk_dir
+        self.chunks = chunks
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        chunk_file, serializer = self.chunks[idx]
+        return SERIALIZERS[serializer][2](os.path.join(self.chunk_dir, chunk_file))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def concatenate(self, axis=0):
+        """
+        Concatenate all chunks into one array
+        :param axis: the axis to concatenate the chunks
+        :return: the concatenated array
+        """
+        return np.concatenate(list(self), axis=axis)
 
 
 class ProcessBlock(object):
-    def __init__(self, process_func, process_dir, process_name=None):
+    def __init__(self, process_func, process_dir, process_name=None, max_cache_size=None, serializer=None,
+                 stale_timeout=60):
+        """
+        Results of process_func are cached in process_dir, keyed by the hash of the kwargs of run() and the code of
+        process_func, so that results of different kwargs are kept side by side and changing process_func invalidates
+        the cached results
+        :param process_func: the function to run
+        :param process_dir: the directory to store the state files and results
+        :param process_name: the prefix of the files, the name of process_func will be used if not given
+        :param max_cache_size: if given, the least recently used results will be removed once the total size in
+                               bytes of the results of this block exceeds this value
+        :param serializer: name of the serializer in SERIALIZERS used to save the results, if None, it will be chosen
+                           by the type of the result, see detect_serializer, the serializers in ARRAY_SERIALIZERS
+                           raise ValueError for results that are not numpy arrays
+        :param stale_timeout: seconds without heartbeat after which the lock of another worker is considered stale,
+                              see FileLock
+        """
+        if serializer is not None and serializer not in SERIALIZERS:
+            raise ValueError('serializer {} not understood, should be one of {}'.format(
+                serializer, list(SERIALIZERS.keys())))
         self.process_func = process_func
         self.process_dir = process_dir
         make_dir_if_not_exist(self.process_dir)
@@ -30,47 +472,433 @@ class ProcessBlock(object):
             self.process_name = process_func.__name__
         else:
             self.process_name = process_name
+        self.max_cache_size = max_cache_size
+        self.serializer = serializer
+        self.stale_timeout = stale_timeout
+
+    def get_key(self, **kwargs):
+        """
+        Get the cache key of running process_func with the given kwargs
+        :param kwargs: parameters used by process_func
+        :return: the hex string key
+        """
+        hasher = hashlib.sha1()
+        _update_hash(hasher, _get_func_code(self.process_func))
+        _update_hash(hasher, kwargs)
+        return hasher.hexdigest()[:KEY_LEN]
 
     @staticmethod
     def check_complete(state_file):
         """
         check complete status of running process_func
-        :param state_file: file where stores the complete status as True (Complete) or False (Incomplete)
-        :return: Complete as True, Incomplete as False
+        :param state_file: json file where stores the status, time and host of the last run
+        :return: Complete as True, Incomplete or not started as False
         """
-        state = load_file(state_file)[0]
-        if state == 'Complete':
-            return True
-        else:
+        if not os.path.exists(state_file):
             return False
+        return load_file(state_file)['status'] == 'Complete'
+
+    @staticmethod
+    def _save_state(state_file, status, start_time):
+        """
+        Save the status of running process_func
+        :param state_file: json file to save the state
+        :param status: 'Incomplete' or 'Complete'
+        :param start_time: the time.time() when the process started
+        :return:
+        """
+        state = {'status': status, 'host': socket.gethostname(), 'pid': os.getpid(), 'start_time': start_time,
+                 'end_time': None, 'duration': None}
+        if status == 'Complete':
+            state['end_time'] = time.time()
+            state['duration'] = state['end_time'] - start_time
+        save_file(state_file, state, atomic=True)
+
+    def _get_file(self, key, suffix):
+        return os.path.join(self.process_dir, '{}_{}{}'.format(self.process_name, key, suffix))
+
+    def _get_cached_keys(self):
+        """
+        Get the files of each cached key of this block
+        :return: dict maps key to list of file paths
+        """
+        pattern = re.compile(r'^{}_([0-9a-f]{{{}}})[._]'.format(re.escape(self.process_name), KEY_LEN))
+        cached = {}
+        for file_name in os.listdir(self.process_dir):
+            match = pattern.match(file_name)
+            if match and '.lock' not in file_name:
+                cached.setdefault(match.group(1), []).append(os.path.join(self.process_dir, file_name))
+        return cached
+
+    def prune_cache(self, keep_key=None):
+        """
+        Remove the least recently used results until their total size is no larger than max_cache_size
+        :param keep_key: the key that will never be removed
+        :return: list of removed keys
+        """
+        if self.max_cache_size is None:
+            return []
+        def get_stats(path):
+            if not os.path.isdir(path):
+                stat = os.stat(path)
+                return stat.st_mtime, stat.st_size
+            stats = [os.stat(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files]
+            return max([a.st_mtime for a in stats], default=0), sum(a.st_size for a in stats)
+
+        cached = []
+        for key, files in self._get_cached_keys().items():
+            stats = [get_stats(f) for f in files]
+            cached.append((max(a[0] for a in stats), sum(a[1] for a in stats), key, files))
+        total_size = sum(a[1] for a in cached)
+        removed = []
+        for _, size, key, files in sorted(cached):
+            if total_size <= self.max_cache_size:
+                break
+            if key == keep_key or os.path.exists(self._get_file(key, '.lock')):
+                continue
+            for f in files:
+                if os.path.isdir(f):
+                    shutil.rmtree(f)
+                else:
+                    os.remove(f)
+            total_size -= size
+            removed.append(key)
+        return removed
+
+    def _get_serializer(self, val):
+        """
+        Get the serializer of the result value, results that are not numpy arrays can't be saved by the array only
+        serializers, as they could be saved but not loaded back
+        :param val: the result value
+        :return: name of the serializer
+        """
+        if self.serializer is None:
+            return detect_serializer(val)
+        if self.serializer in ARRAY_SERIALIZERS and detect_serializer(val) != 'npy':
+            raise ValueError('serializer {} only saves numpy arrays, {} got {}'.format(
+                self.serializer, self.process_name, type(val).__name__))
+        return self.serializer
+
+    def _get_value_file(self, key, serializer):
+        return os.path.join(self.process_dir, '{}_{}.{}'.format(self.process_name, key, SERIALIZERS[serializer][0]))
+
+    def _find_value_file(self, key):
+        """
+        Find the existing result file of the key
+        :param key: the cache key
+        :return: the serializer name and the path to the result file, or (None, None) if not found
+        """
+        serializers = [self.serializer] if self.serializer is not None else SERIALIZERS.keys()
+        for serializer in serializers:
+            value_file = self._get_value_file(key, serializer)
+            if os.path.exists(value_file):
+                return serializer, value_file
+        return None, None
+
+    def _get_chunk_dir(self, key):
+        return self._get_file(key, '_chunks')
+
+    def _load_value(self, key, verbose):
+        """
+        Load the result of the key if it has been completed
+        :param key: the cache key
+        :param verbose: if True, will print the intermediate messages
+        :return: whether the result is found and the result
+        """
+        if not self.check_complete(self._get_file(key, '_state.json')):
+            return False, None
+        if inspect.isgeneratorfunction(self.process_func):
+            manifest_file = os.path.join(self._get_chunk_dir(key), 'manifest.json')
+            if not os.path.exists(manifest_file):
+                return False, None
+            manifest = load_file(manifest_file)
+            if not manifest['complete']:
+                return False, None
+            val = ChunkedResult(self._get_chunk_dir(key), manifest['chunks'])
+            value_file = manifest_file
+        else:
+            serializer, value_file = self._find_value_file(key)
+            if value_file is None:
+                return False, None
+            val = SERIALIZERS[serializer][2](value_file)
+        verb_print('File already exits, load value', verbose)
+        # mark as recently used
+        os.utime(value_file)
+        return True, val
+
+    def _run_value(self, key, verbose, kwargs):
+        """
+        Run process_func and save the result
+        :return: result value of process_func
+        """
+        verb_print('Start running process {}'.format(self.process_name), verbose)
+        _, value_file = self._find_value_file(key)
+        if value_file is not None:
+            os.remove(value_file)
+        val = self.process_func(**kwargs)
+        serializer = self._get_serializer(val)
+        SERIALIZERS[serializer][1](self._get_value_file(key, serializer), val)
+        return val
+
+    def _run_chunks(self, key, force_run, verbose, kwargs):
+        """
+        Run the generator process_func, each yielded chunk is saved once it arrives and recorded in the manifest, so
+        that an interrupted run resumes after the last saved chunk
+        If process_func accepts a start_chunk parameter, it will be given the number of chunks already saved and
+        should start yielding from there, otherwise the saved chunks are generated again and skipped
+        :return: ChunkedResult of the saved chunks
+        """
+        chunk_dir = self._get_chunk_dir(key)
+        manifest_file = os.path.join(chunk_dir, 'manifest.json')
+        if force_run and os.path.exists(chunk_dir):
+            shutil.rmtree(chunk_dir)
+        make_dir_if_not_exist(chunk_dir)
+        if os.path.exists(manifest_file):
+            manifest = load_file(manifest_file)
+        else:
+            manifest = {'chunks': [], 'complete': False}
+
+        start_chunk = len(manifest['chunks'])
+        if start_chunk > 0:
+            verb_print('Resume process {} from chunk {}'.format(self.process_name, start_chunk), verbose)
+        else:
+            verb_print('Start running process {}'.format(self.process_name), verbose)
+        if 'start_chunk' in inspect.signature(self.process_func).parameters:
+            chunks = self.process_func(start_chunk=start_chunk, **kwargs)
+        else:
+            chunks = itertools.islice(self.process_func(**kwargs), start_chunk, None)
+
+        for chunk in chunks:
+            serializer = self._get_serializer(chunk)
+            chunk_file = 'chunk_{:06d}.{}'.format(len(manifest['chunks']), SERIALIZERS[serializer][0])
+            SERIALIZERS[serializer][1](os.path.join(chunk_dir, chunk_file), chunk)
+            manifest['chunks'].append([chunk_file, serializer])
+            save_file(manifest_file, manifest, atomic=True)
+        manifest['complete'] = True
+        save_file(manifest_file, manifest, atomic=True)
+        return ChunkedResult(chunk_dir, manifest['chunks'])
 
     def run(self, force_run=False, verbose=True, **kwargs):
         """
         run the process func, update state_file and save the result value
+        Only one worker runs the process of the same key at a time, others wait for its lock and then load the
+        result, see FileLock
+        If process_func is a generator function, its chunks are checkpointed one by one, see _run_chunks
         :param force_run: force the process_func to run again no matter whether the complete status is incomplete or not
         :param verbose: if True, will print the intermediate messages
         :param kwargs: other parameters used by process_func
-        :return: result value of process_func
+        :return: result value of process_func, or ChunkedResult if process_func is a generator function
         """
-        state_file = os.path.join(self.process_dir, '{}_state.txt'.format(self.process_name))
-        value_file = os.path.join(self.process_dir, '{}.pkl'.format(self.process_name))
-        # write state file as incomplete if the state file does not exist
-        if not os.path.exists(state_file):
-            save_file(state_file, 'Incomplete')
+        return self._run(self.get_key(**kwargs), force_run, verbose, kwargs)
 
-        if not self.check_complete(state_file) or not os.path.exists(value_file) or force_run:
-            # run the process
-            verb_print('Start running process {}'.format(self.process_name), verbose)
-            save_file(state_file, 'Incomplete')
+    def _run(self, key, force_run, verbose, kwargs):
+        """
+        Run the process func under the given cache key, see run
+        :param key: the cache key
+        :param force_run: force the process_func to run again
+        :param verbose: if True, will print the intermediate messages
+        :param kwargs: parameters used by process_func
+        :return: result value of process_func, or ChunkedResult if process_func is a generator function
+        """
+        if not force_run:
+            found, val = self._load_value(key, verbose)
+            if found:
+                return val
 
-            val = self.process_func(**kwargs)
-            save_file(value_file, val)
+        with FileLock(self._get_file(key, '.lock'), stale_timeout=self.stale_timeout):
+            if not force_run:
+                # the result might be finished by another worker while waiting for the lock
+                found, val = self._load_value(key, verbose)
+                if found:
+                    return val
 
-            save_file(state_file, 'Complete')
+            state_file = self._get_file(key, '_state.json')
+            start_time = time.time()
+            self._save_state(state_file, 'Incomplete', start_time)
+            if inspect.isgeneratorfunction(self.process_func):
+                val = self._run_chunks(key, force_run, verbose, kwargs)
+            else:
+                val = self._run_value(key, verbose, kwargs)
+            self._save_state(state_file, 'Complete', start_time)
             verb_print('Complete!', verbose)
-        else:
-            # load the data
-            verb_print('File already exits, load value', verbose)
-            val = load_file(value_file)
+        self.prune_cache(keep_key=key)
+        return val
+
+    def map(self, param_grid, workers=None, backend='process', force_run=False, verbose=True):
+        """
+        Run process_func with each set of parameters in the grid on a pool, each shard is cached under its own key,
+        so that finished shards are loaded instead of run again when restarted
+        :param param_grid: list of kwargs dicts, or a dict maps each parameter name to a list of values, in which case
+                           every combination of the values will be run
+        :param workers: number of workers, if None or 1, the shards will be run one by one in the current process
+        :param backend: 'thread' or 'process', the type of the pool, process_func should be picklable for process
+        :param force_run: if True, all shards will be run again
+        :param verbose: if True, will print the intermediate messages
+        :return: list of results in the same order as the parameters
+        """
+        if isinstance(param_grid, dict):
+            names = list(param_grid.keys())
+            param_grid = [dict(zip(names, values)) for values in itertools.product(*param_grid.values())]
+        results = [None] * len(param_grid)
+        todo = []
+        for cnt, kwargs in enumerate(param_grid):
+            found = False
+            if not force_run:
+                found, results[cnt] = self._load_value(self.get_key(**kwargs), verbose=False)
+            if not found:
+                todo.append(cnt)
+        verb_print('{}: {} of {} shards are cached, run the rest'.format(
+            self.process_name, len(param_grid) - len(todo), len(param_grid)), verbose)
+
+        run_shard = partial(_run_shard, self, force_run)
+        for cnt, val in zip(todo, _iter_map(run_shard, [param_grid[a] for a in todo], workers, backend)):
+            results[cnt] = val
+        verb_print('{}: Complete!'.format(self.process_name), verbose)
+        return results
+
 
+def _run_shard(block, force_run, kwargs):
+    """
+    Run the block with one set of parameters, this is a module level function so that it can be sent to a process pool
+    """
+    return block.run(force_run=force_run, verbose=False, **kwargs)
+
+
+class _StageResult(object):
+    """
+    Reference to the cached result of a pipeline stage, it is sent between processes instead of the result itself and
+    only loaded where the result is needed
+    """
+    def __init__(self, block, key):
+        self.block = block
+        self.key = key
+
+    def load(self):
+        found, val = self.block._load_value(self.key, verbose=False)
+        if not found:
+            raise IOError('Result of {} with key {} is no longer cached'.format(self.block.process_name, self.key))
         return val
+
+
+def _run_stage(block, key, force_run, verbose, kwargs, lazy=False):
+    """
+    Run the block under the given key and time it, this is a module level function so that it can be sent to a
+    process pool, the upstream results given as _StageResult are only loaded if the block is not cached
+    :param lazy: if True, a _StageResult is returned instead of the result value, so that the result is not pickled
+    :return: result value of the block and the wall time in seconds
+    """
+    start_time = time.perf_counter()
+    found = False
+    if not force_run:
+        found, val = block._load_value(key, verbose)
+    if not found:
+        kwargs = {k: v.load() if isinstance(v, _StageResult) else v for k, v in kwargs.items()}
+        val = block._run(key, force_run, verbose, kwargs)
+    duration = time.perf_counter() - start_time
+    if lazy:
+        val = _StageResult(block, key)
+    return val, duration
+
+
+# Placeholder of an upstream result when computing the cache key of a downstream stage
+_UpstreamKey = collections.namedtuple('_UpstreamKey', ['key'])
+
+
+class Pipeline(object):
+    def __init__(self):
+        """
+        A DAG of ProcessBlocks, the results of the upstream blocks are passed to the downstream ones as kwargs, blocks
+        whose dependencies are finished are run concurrently
+        The downstream blocks are keyed by the cache keys of their upstream blocks instead of the upstream results, so
+        cached results are never read just to be hashed, and only the blocks whose own or upstream code or parameters
+        have changed are executed again
+        On a process pool, the workers load the upstream results from the cache only when their block has to run, and
+        send back references to their cached results instead of the results themselves
+        """
+        self.stages = collections.OrderedDict()
+        self.timings = {}
+
+    def add(self, block, depends=(), name=None, **kwargs):
+        """
+        Add a block to the pipeline, the dependencies should be added before it
+        :param block: the ProcessBlock to run, should be picklable if the pipeline runs on a process pool
+        :param depends: list of upstream stage names, their results are passed as kwargs with the same names, or a
+                        dict maps the kwarg names to the upstream stage names
+        :param name: the stage name, the process_name of the block will be used if not given
+        :param kwargs: other parameters used by the block
+        :return: the stage name
+        """
+        if name is None:
+            name = block.process_name
+        if name in self.stages:
+            raise ValueError('Stage {} already exists'.format(name))
+        if not isinstance(depends, dict):
+            depends = {a: a for a in depends}
+        for upstream in depends.values():
+            if upstream not in self.stages:
+                raise ValueError('Upstream stage {} of {} does not exist'.format(upstream, name))
+        self.stages[name] = (block, depends, kwargs)
+        return name
+
+    def run(self, workers=None, backend='process', force_run=False, verbose=True):
+        """
+        Run all stages in the pipeline
+        :param workers: number of workers, if None or 1, the stages will be run one by one in the current process
+        :param backend: 'thread' or 'process', the type of the pool
+        :param force_run: if True, all blocks will be run again, or a list of stage names to run again
+        :param verbose: if True, will print the intermediate messages
+        :return: dict maps stage name to its result
+        """
+        def get_args(name):
+            block, depends, kwargs = self.stages[name]
+            keys[name] = block.get_key(**dict(kwargs, **{k: _UpstreamKey(keys[v]) for k, v in depends.items()}))
+            kwargs = dict(kwargs, **{k: results[v] for k, v in depends.items()})
+            stage_force_run = force_run if isinstance(force_run, bool) else name in force_run
+            return block, keys[name], stage_force_run, verbose, kwargs
+
+        def finish(name, val, duration):
+            results[name] = val
+            self.timings[name] = duration
+            verb_print('Stage {} finished in {:.3f}s'.format(name, duration), verbose)
+
+        results, keys = {}, {}
+        self.timings = {}
+        if workers is None or workers <= 1:
+            for name in self.stages:
+                finish(name, *_run_stage(*get_args(name)))
+            return results
+
+        # on a process pool, the results stay in the cache and only references to them are sent between processes
+        lazy = backend == 'process'
+        pending = list(self.stages.keys())
+        running = {}
+        with _get_executor(workers, backend) as executor:
+            while pending or running:
+                for name in [a for a in pending if all(b in results for b in self.stages[a][1].values())]:
+                    pending.remove(name)
+                    running[executor.submit(_run_stage, *get_args(name), lazy=lazy)] = name
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    finish(running.pop(future), *future.result())
+        return {name: val.load() if isinstance(val, _StageResult) else val for name, val in results.items()}
+
+    def critical_path(self):
+        """
+        Get the chain of stages with the longest total wall time in the last run
+        :return: list of stage names along the path and its total wall time in seconds
+        """
+        # stages are added after their dependencies, so they are already in topological order
+        path_time, path_prev = {}, {}
+        for name, (_, depends, _) in self.stages.items():
+            prev = max(depends.values(), key=lambda a: path_time[a], default=None)
+            path_prev[name] = prev
+            path_time[name] = self.timings.get(name, 0) + (path_time[prev] if prev is not None else 0)
+        if not path_time:
+            return [], 0
+        name = max(path_time, key=lambda a: path_time[a])
+        total_time = path_time[name]
+        path = []
+        while name is not None:
+            path.append(name)
+            name = path_prev[name]
+        return path[::-1], total_time
@@ -5,9 +5,11 @@
 
 # Built-in
 import os
+import pickle
 import shutil
 
 # Libs
+import cv2
 import pytest
 import numpy as np
 
@@ -85,3 +87,120 @@ def test_change_order(shape):
     data = np.random.random(shape)
     data_new = img_utils.change_channel_order(img_utils.change_channel_order(data), False)
     np.testing.assert_array_almost_equal(data, data_new)
+
+
+@pytest.mark.parametrize('connectivity', [4, 8])
+@pytest.mark.parametrize('dilate', [True, False])
+def test_seg_to_bbox(connectivity, dilate):
+    img = (np.random.random((256, 256)) > 0.7).astype(np.uint8)
+
+    bboxes = img_utils.seg_to_bbox(img, dilate=dilate, min_area=5, connectivity=connectivity)
+    bboxes_sk = img_utils.seg_to_bbox(img, dilate=dilate, min_area=5, connectivity=connectivity, backend='skimage')
+    assert bboxes == bboxes_sk
+
+    bboxes, areas, centroids = img_utils.seg_to_bbox(img, dilate=dilate, min_area=5, max_area=100,
+                                                     connectivity=connectivity, return_stats=True)
+    assert bboxes.shape == (len(areas), 4) and centroids.shape == (len(areas), 2)
+    assert np.all((areas > 5) & (areas <= 100))
+    assert np.all((centroids >= bboxes[:, :2]) & (centroids < bboxes[:, 2:]))
+
+
+def test_seg_to_bbox_objects():
+    img = np.zeros((100, 100), dtype=np.uint8)
+    img[10:20, 10:30] = 1
+    img[50:90, 60:70] = 1
+    img[95:97, 0:2] = 1
+
+    assert img_utils.seg_to_bbox(img, dilate=False) == [(10, 10, 20, 30), (50, 60, 90, 70)]
+    bboxes, areas, centroids = img_utils.seg_to_bbox(img, dilate=False, min_area=0, max_area=200,
+                                                     return_stats=True)
+    np.testing.assert_array_equal(bboxes, [[10, 10, 20, 30], [95, 0, 97, 2]])
+    np.testing.assert_array_equal(areas, [200, 4])
+    np.testing.assert_array_almost_equal(centroids, [[14.5, 19.5], [95.5, 0.5]])
+
+
+@pytest.mark.parametrize('connectivity', [4, 8])
+@pytest.mark.parametrize('dilate', [True, False])
+@pytest.mark.parametrize('tile_size', [7, 32, 100])
+def test_seg_to_bbox_tiled(connectivity, dilate, tile_size):
+    img = (np.random.random((90, 110)) > 0.6).astype(np.uint8)
+
+    bboxes, areas, centroids = img_utils.seg_to_bbox(img, dilate=dilate, min_area=3, connectivity=connectivity,
+                                                     return_stats=True)
+    bboxes_t, areas_t, centroids_t = img_utils.seg_to_bbox_tiled(img, tile_size=tile_size, dilate=dilate, min_area=3,
+                                                                 connectivity=connectivity, return_stats=True)
+    np.testing.assert_array_equal(bboxes, bboxes_t)
+    np.testing.assert_array_equal(areas, areas_t)
+    np.testing.assert_array_almost_equal(centroids, centroids_t)
+
+
+@pytest.mark.parametrize('ext', ['npy', 'png'])
+def test_seg_tiled_file(ext):
+    test_dir = './temp'
+    misc_utils.make_dir_if_not_exist(test_dir)
+
+    img = np.zeros((300, 300), dtype=np.uint8)
+    for r, c in np.random.randint(0, 280, (50, 2)):
+        img[r:r + np.random.randint(3, 20), c:c + np.random.randint(3, 20)] = 255
+    save_name = os.path.join(test_dir, f'mask.{ext}')
+    misc_utils.save_file(save_name, img)
+
+    assert img_utils.seg_to_bbox_tiled(save_name, tile_size=64, workers=2) == img_utils.seg_to_bbox(img)
+    polygons = img_utils.seg_to_polygon_tiled(save_name, tile_size=64, workers=2)
+    assert sorted(polygons.tolist()) == sorted(img_utils.seg_to_polygon(img).tolist())
+
+    shutil.rmtree(test_dir)
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+@pytest.mark.parametrize('chunksize', [1, 3])
+def test_batch_seg(workers, chunksize):
+    test_dir = './temp'
+    misc_utils.make_dir_if_not_exist(test_dir)
+
+    imgs = [(np.random.random((64, 64)) > 0.8).astype(np.uint8) * 255 for _ in range(7)]
+    save_names = [os.path.join(test_dir, f'mask_{i}.png') for i in range(len(imgs))]
+    for save_name, img in zip(save_names, imgs):
+        misc_utils.save_file(save_name, img)
+
+    for inputs in [imgs, save_names]:
+        bboxes = img_utils.batch_seg_to_bbox(inputs, workers=workers, chunksize=chunksize, min_area=5)
+        assert list(bboxes) == [img_utils.seg_to_bbox(img, min_area=5) for img in imgs]
+        polygons = img_utils.batch_seg_to_polygon(inputs, workers=workers, chunksize=chunksize)
+        assert [p.tolist() for p in polygons] == [img_utils.seg_to_polygon(img).tolist() for img in imgs]
+
+    shutil.rmtree(test_dir)
+
+
+def test_polygons():
+    img = np.zeros((100, 100), dtype=np.uint8)
+    img[10:20, 10:30] = 1
+    img[50:90, 60:70] = 1
+    img[40:45, 0:3] = 1
+    img[60:70, 20:40] = 1
+    img[63:67, 25:35] = 0
+
+    polygons = img_utils.seg_to_polygon(img)
+    contours, _ = cv2.findContours(img, 1, 2)
+    assert len(polygons) == len(contours) == 5
+    assert polygons.tolist() == [[a[0].tolist() for a in contour] for contour in contours]
+    np.testing.assert_array_equal(polygons.lengths, [len(contour) for contour in contours])
+    np.testing.assert_array_almost_equal(polygons.areas(), [cv2.contourArea(contour) for contour in contours])
+    # besides the hole, the bboxes of the polygons match the bboxes of the objects
+    bboxes = set(map(tuple, polygons.bboxes().tolist()))
+    assert len(bboxes) == 5 and set(img_utils.seg_to_bbox(img, dilate=False, min_area=0)) < bboxes
+
+    for polygon, contour in zip(polygons, contours):
+        np.testing.assert_array_equal(polygon, contour[:, 0])
+    np.testing.assert_array_equal(polygons[-1], contours[-1][:, 0])
+    with pytest.raises(IndexError):
+        polygons[5]
+    assert polygons[1:4].tolist() == polygons.tolist()[1:4]
+    assert polygons[[4, 0]].tolist() == [polygons.tolist()[4], polygons.tolist()[0]]
+    mask = polygons.areas() > 100
+    np.testing.assert_array_equal(polygons[mask].areas(), polygons.areas()[mask])
+
+    assert pickle.loads(pickle.dumps(polygons)).tolist() == polygons.tolist()
+    assert img_utils.Polygons.from_contours(polygons.tolist()).tolist() == polygons.tolist()
+    empty = img_utils.seg_to_polygon(np.zeros((10, 10), dtype=np.uint8))
+    assert len(empty) == 0 and empty.areas().shape == (0, ) and empty.bboxes().shape == (0, 4)
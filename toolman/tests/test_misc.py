@@ -5,7 +5,11 @@
 
 # Built-in
 import os
+import sys
+import json
 import shutil
+import pathlib
+import subprocess
 
 # Libs
 import pytest
@@ -25,16 +29,60 @@ def test_str2list(s, sep, d_type, l_len):
     assert len(l) == l_len
 
 
-@pytest.mark.parametrize('ext', ['npy', 'pkl'])
-def test_io_funcs(ext):
+def test_timer_decorator(capsys):
+    @misc_utils.timer_decorator
+    def func(a):
+        return a + 1
+
+    assert func(1) == 2
+    assert 'duration' in capsys.readouterr().out
+
+
+def test_profiler():
+    profiler = misc_utils.Profiler()
+
+    @profiler.profile()
+    def func(a):
+        return a + 1
+
+    @profiler.profile('other')
+    def other_func():
+        pass
+
+    for i in range(10):
+        assert func(i) == i + 1
+    other_func()
+    with profiler.profile('block'):
+        with profiler.profile('block'):
+            pass
+
+    stats = profiler.stats()
+    assert stats[func.__qualname__]['count'] == 10
+    assert stats['other']['count'] == 1 and stats['block']['count'] == 2
+    for v in stats.values():
+        assert v['p50'] <= v['p95'] <= v['max'] <= v['total']
+    assert 'block' in profiler.report()
+    assert json.loads(profiler.report('json'))['other']['count'] == 1
+
+    profiler.reset()
+    profiler.disable()
+    func(1)
+    with profiler.profile('block'):
+        pass
+    assert profiler.stats() == {}
+
+
+@pytest.mark.parametrize('ext', ['npy', 'pkl', 'NPY', 'Pkl'])
+@pytest.mark.parametrize('atomic', [False, True])
+def test_io_funcs(ext, atomic):
     test_dir = './temp'
     misc_utils.make_dir_if_not_exist(test_dir)
     assert os.path.exists(test_dir)
 
     data = np.random.random((512, 512, 3))
     save_name = os.path.join(test_dir, f'dat.{ext}')
-    misc_utils.save_file(save_name, data)
-    assert os.path.exists(save_name)
+    misc_utils.save_file(save_name, data, atomic=atomic)
+    assert os.listdir(test_dir) == [f'dat.{ext}']
 
     data_read = misc_utils.load_file(save_name)
     np.testing.assert_array_almost_equal(data_read, data)
@@ -42,6 +90,30 @@ def test_io_funcs(ext):
     shutil.rmtree(test_dir)
 
 
+@pytest.mark.parametrize('mmap_mode', [None, 'r'])
+@pytest.mark.parametrize('index', [None, slice(10, 20), (slice(None), 3), [1, 5, 7]])
+def test_io_funcs_npy_partial(mmap_mode, index):
+    test_dir = './temp'
+    misc_utils.make_dir_if_not_exist(test_dir)
+    assert os.path.exists(test_dir)
+
+    data = np.random.random((100, 8))
+    save_name = os.path.join(test_dir, 'dat.npy')
+    misc_utils.save_file(save_name, data)
+
+    data_read = misc_utils.load_file(save_name, mmap_mode=mmap_mode, index=index)
+    expected = data if index is None else data[index]
+    np.testing.assert_array_almost_equal(data_read, expected)
+    if mmap_mode == 'r' and not isinstance(index, list):
+        # basic slices of a read-only memmap are views
+        assert not data_read.flags.writeable
+    else:
+        assert not isinstance(data_read, np.memmap)
+    del data_read
+
+    shutil.rmtree(test_dir)
+
+
 @pytest.mark.parametrize('s', [
     'abcdefg',
     'a\nb\nc\n',
@@ -84,6 +156,84 @@ def test_io_funcs_json():
     shutil.rmtree(test_dir)
 
 
+@pytest.mark.parametrize('shape', [(100, ), (100, 4)])
+@pytest.mark.parametrize('fmt', ['%.8e', '%d'])
+def test_io_funcs_csv(shape, fmt):
+    test_dir = './temp'
+    misc_utils.make_dir_if_not_exist(test_dir)
+    assert os.path.exists(test_dir)
+
+    data = np.random.randint(0, 100, shape)
+    save_name = os.path.join(test_dir, 'dat.csv')
+    savetxt_name = os.path.join(test_dir, 'dat_savetxt.csv')
+    misc_utils.save_file(save_name, data, fmt=fmt)
+    np.savetxt(savetxt_name, data, delimiter=',', fmt=fmt)
+    with open(save_name, 'r') as f1, open(savetxt_name, 'r') as f2:
+        assert f1.read() == f2.read()
+
+    shutil.rmtree(test_dir)
+
+
+def test_io_funcs_csv_chunks():
+    import pandas as pd
+
+    test_dir = './temp'
+    misc_utils.make_dir_if_not_exist(test_dir)
+    assert os.path.exists(test_dir)
+
+    data = np.random.random((100, 3))
+    save_name = os.path.join(test_dir, 'dat.csv')
+    misc_utils.save_file(save_name, data[:50], header=['a', 'b', 'c'])
+    misc_utils.save_file(save_name, pd.DataFrame(data[50:], columns=['a', 'b', 'c']), mode='a')
+
+    df = misc_utils.load_file(save_name)
+    assert list(df.columns) == ['a', 'b', 'c']
+    np.testing.assert_array_almost_equal(df.to_numpy(), data)
+
+    chunks = list(misc_utils.load_file(save_name, chunksize=30, to_numpy=True))
+    assert [len(a) for a in chunks] == [30, 30, 30, 10]
+    np.testing.assert_array_almost_equal(np.concatenate(chunks), data)
+
+    shutil.rmtree(test_dir)
+
+
+def test_io_funcs_yaml():
+    d = {'a': 123, 'b': 'abc', 'c': [1, 2, 3]}
+
+    test_dir = './temp'
+    misc_utils.make_dir_if_not_exist(test_dir)
+    assert os.path.exists(test_dir)
+
+    save_name = os.path.join(test_dir, 'dat.yaml')
+    misc_utils.save_file(save_name, d)
+    assert misc_utils.load_file(save_name) == d
+
+    shutil.rmtree(test_dir)
+
+
+def test_register_format():
+    def loader(file_name, **kwargs):
+        with open(file_name, 'r') as f:
+            return f.read().split('|')
+
+    def saver(file_name, data, **kwargs):
+        with open(file_name, 'w') as f:
+            f.write('|'.join(data))
+
+    misc_utils.register_format('bar', loader=loader, saver=saver)
+
+    test_dir = './temp'
+    misc_utils.make_dir_if_not_exist(test_dir)
+    assert os.path.exists(test_dir)
+
+    d = ['a', 'b', 'c']
+    save_name = os.path.join(test_dir, 'dat.BAR')
+    misc_utils.save_file(save_name, d)
+    assert misc_utils.load_file(save_name) == d
+
+    shutil.rmtree(test_dir)
+
+
 @pytest.mark.parametrize('ext', ['png', 'tif'])
 def test_io_funcs_image(ext):
     img = np.random.randint(0, 256, (512, 512, 3))
@@ -122,6 +272,235 @@ def test_io_funcs_image_pil():
     shutil.rmtree(test_dir)
 
 
+def test_io_stats():
+    test_dir = './temp'
+    misc_utils.make_dir_if_not_exist(test_dir)
+    assert os.path.exists(test_dir)
+
+    misc_utils.reset_io_stats()
+    misc_utils.enable_io_stats()
+    try:
+        data = np.random.random((16, 16))
+        misc_utils.save_file(os.path.join(test_dir, 'dat.npy'), data)
+        misc_utils.save_file(os.path.join(test_dir, 'dat.json'), {'a': 1})
+        misc_utils.save_file(os.path.join(test_dir, 'dat_atomic.npy'), data, atomic=True)
+        misc_utils.save_file(os.path.join(test_dir, 'dat.PNG'), np.zeros((4, 4)), atomic=True)
+        for _ in range(3):
+            misc_utils.load_file(os.path.join(test_dir, 'dat.npy'))
+        with pytest.raises(IOError):
+            misc_utils.load_file(os.path.join(test_dir, 'missing.png'))
+    finally:
+        misc_utils.enable_io_stats(False)
+    misc_utils.load_file(os.path.join(test_dir, 'dat.json'))
+
+    stats = misc_utils.io_stats()
+    assert stats['save']['npy']['calls'] == 2 and stats['save']['json']['calls'] == 1
+    # atomic saves are recorded under the same extensions
+    assert sorted(stats['save'].keys()) == ['json', 'npy', 'png']
+    assert stats['load']['npy']['calls'] == 3
+    assert stats['load']['npy']['bytes'] == 3 * os.path.getsize(os.path.join(test_dir, 'dat.npy'))
+    assert stats['load']['png']['errors'] == 1
+    assert 'json' not in stats['load']
+
+    misc_utils.reset_io_stats()
+    assert misc_utils.io_stats() == {'load': {}, 'save': {}}
+
+    shutil.rmtree(test_dir)
+
+
+def test_file_cache():
+    test_dir = './temp'
+    misc_utils.make_dir_if_not_exist(test_dir)
+    assert os.path.exists(test_dir)
+
+    data = np.random.random((64, 64))
+    save_names = [os.path.join(test_dir, f'dat_{i}.npy') for i in range(3)]
+    for save_name in save_names:
+        misc_utils.save_file(save_name, data)
+
+    # the budget only fits two arrays
+    cache = misc_utils.FileCache(max_bytes=2 * data.nbytes)
+    data_read = misc_utils.load_file(save_names[0], cache=cache)
+    assert cache.load(save_names[0]) is data_read
+    assert not data_read.flags.writeable
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+    cache.load(save_names[1])
+    cache.load(save_names[2])
+    assert cache.stats()['entries'] == 2
+    assert cache.stats()['bytes'] == 2 * data.nbytes
+    cache.load(save_names[0])
+    assert cache.stats()['misses'] == 4
+
+    # changed files will be read again
+    misc_utils.save_file(save_names[0], np.zeros((8, 8)))
+    np.testing.assert_array_equal(cache.load(save_names[0]), np.zeros((8, 8)))
+    assert cache.stats()['misses'] == 5
+
+    # partial reads are keyed by the full content of the index, not its abbreviated repr
+    save_name = os.path.join(test_dir, 'dat_long.npy')
+    misc_utils.save_file(save_name, np.arange(5000))
+    index = np.arange(2000)
+    np.testing.assert_array_equal(cache.load(save_name, index=index), np.arange(2000))
+    index = index.copy()
+    index[500] = 4999
+    assert cache.load(save_name, index=index)[500] == 4999
+    assert cache.stats()['misses'] == 7
+
+    shutil.rmtree(test_dir)
+
+
+@pytest.mark.parametrize('workers, backend', [
+    (None, 'thread'),
+    (4, 'thread'),
+    (2, 'process'),
+])
+def test_load_files(workers, backend):
+    test_dir = './temp'
+    misc_utils.make_dir_if_not_exist(test_dir)
+    assert os.path.exists(test_dir)
+
+    data = [np.random.random((16, 16)) for _ in range(10)]
+    save_names = [os.path.join(test_dir, f'dat_{i}.npy') for i in range(10)]
+    for save_name, d in zip(save_names, data):
+        misc_utils.save_file(save_name, d)
+
+    data_read = misc_utils.load_files(save_names, workers=workers, backend=backend)
+    assert len(data_read) == len(data)
+    for d, d_read in zip(data, data_read):
+        np.testing.assert_array_almost_equal(d_read, d)
+
+    missing_name = os.path.join(test_dir, 'missing.npy')
+    with pytest.raises(IOError, match=missing_name):
+        misc_utils.load_files(save_names + [missing_name], workers=workers, backend=backend)
+
+    shutil.rmtree(test_dir)
+
+
+@pytest.mark.parametrize('workers, prefetch', [
+    (None, None),
+    (4, 1),
+    (4, None),
+])
+def test_iter_files(workers, prefetch):
+    test_dir = './temp'
+    misc_utils.make_dir_if_not_exist(test_dir)
+    assert os.path.exists(test_dir)
+
+    data = [np.random.random((16, 16)) for _ in range(10)]
+    save_names = [os.path.join(test_dir, f'dat_{i}.npy') for i in range(10)]
+    for save_name, d in zip(save_names, data):
+        misc_utils.save_file(save_name, d)
+
+    cnt = 0
+    for (file_name, d_read), save_name, d in zip(misc_utils.iter_files(save_names, prefetch, workers),
+                                                  save_names, data):
+        assert file_name == save_name
+        np.testing.assert_array_almost_equal(d_read, d)
+        cnt += 1
+    assert cnt == len(data)
+
+    shutil.rmtree(test_dir)
+
+
+@pytest.mark.parametrize('workers', [None, 4])
+def test_save_files(workers):
+    test_dir = './temp'
+    misc_utils.make_dir_if_not_exist(test_dir)
+    assert os.path.exists(test_dir)
+
+    data = [np.random.random((16, 16)) for _ in range(10)]
+    save_names = [os.path.join(test_dir, f'dat_{i}.npy') for i in range(10)]
+    misc_utils.save_files(save_names, data, workers=workers)
+    for d, d_read in zip(data, misc_utils.load_files(save_names)):
+        np.testing.assert_array_almost_equal(d_read, d)
+
+    shutil.rmtree(test_dir)
+
+
+def test_async_writer():
+    test_dir = './temp'
+    misc_utils.make_dir_if_not_exist(test_dir)
+    assert os.path.exists(test_dir)
+
+    data = [np.random.randint(0, 256, (16, 16, 3)) for _ in range(10)]
+    save_names = [os.path.join(test_dir, f'dat_{i}.png') for i in range(10)]
+    with misc_utils.AsyncWriter(workers=2, max_queue=4) as writer:
+        for save_name, d in zip(save_names, data):
+            writer.write(save_name, d)
+        writer.flush()
+        for d, d_read in zip(data, misc_utils.load_files(save_names)):
+            np.testing.assert_array_equal(d_read, d)
+    # no temporary files are left
+    assert sorted(os.listdir(test_dir)) == sorted(os.path.basename(a) for a in save_names)
+
+    writer = misc_utils.AsyncWriter()
+    writer.write(os.path.join(test_dir, 'missing_dir', 'dat.npy'), data[0])
+    with pytest.raises(IOError, match='missing_dir'):
+        writer.close()
+
+    shutil.rmtree(test_dir)
+
+
+def test_get_files():
+    test_dir = './temp'
+    for sub_dir in ['a', 'b', os.path.join('b', 'c')]:
+        misc_utils.make_dir_if_not_exist(os.path.join(test_dir, sub_dir))
+    files = [os.path.join(test_dir, a) for a in ['1.png', 'a/2.jpg', 'a/3.txt', 'b/4.png', 'b/c/5.png', 'b/c/6.txt']]
+    for f in files:
+        open(f, 'w').close()
+
+    assert misc_utils.get_files(test_dir, '*.png') == [files[0]]
+    assert misc_utils.get_files(test_dir, ['*.png', '*.jpg'], recursive=True) == \
+        sorted([files[0], files[1], files[3], files[4]])
+
+    # make the directories look old, so that the index can be reused
+    index_file = './temp_index.pkl'
+    for dir_path in [test_dir] + [os.path.join(test_dir, a) for a in ['a', 'b', os.path.join('b', 'c')]]:
+        os.utime(dir_path, (0, 0))
+    assert misc_utils.get_files(test_dir, '*.txt', recursive=True, index_file=index_file) == [files[2], files[5]]
+    index_mtime = os.path.getmtime(index_file)
+    assert misc_utils.get_files(test_dir, '*.txt', recursive=True, index_file=index_file) == [files[2], files[5]]
+    assert os.path.getmtime(index_file) == index_mtime
+
+    open(os.path.join(test_dir, 'b', '7.txt'), 'w').close()
+    shutil.rmtree(os.path.join(test_dir, 'b', 'c'))
+    assert misc_utils.get_files(test_dir, '*.txt', recursive=True, index_file=index_file) == \
+        [files[2], os.path.join(test_dir, 'b', '7.txt')]
+    assert not any(k.endswith(os.path.join('b', 'c')) for k in misc_utils.load_file(index_file))
+
+    os.remove(index_file)
+    shutil.rmtree(test_dir)
+
+
+@pytest.mark.parametrize('path_list, extension', [
+    ('./temp', '*.png'),
+    ('./temp', 'b/*.png'),
+    ('./temp', '*/*.png'),
+    ('./temp', ['*.txt', '*/c/*']),
+    (['./temp', 'b'], '*'),
+    ('./te*', '*.png'),
+    (['./temp', '*'], '*.jpg'),
+    (os.path.abspath('./temp'), 'a/*'),
+])
+def test_get_files_index(path_list, extension):
+    test_dir = './temp'
+    for sub_dir in ['a', 'b', os.path.join('b', 'c')]:
+        misc_utils.make_dir_if_not_exist(os.path.join(test_dir, sub_dir))
+    for f in ['1.png', '.hidden.png', 'a/2.jpg', 'a/3.txt', 'b/4.png', 'b/c/5.png', 'b/c/6.txt']:
+        open(os.path.join(test_dir, f), 'w').close()
+
+    # the index gives the same results as glob
+    index_file = './temp_index.pkl'
+    expected = misc_utils.get_files(path_list, extension)
+    assert len(expected) > 0
+    assert misc_utils.get_files(path_list, extension, index_file=index_file) == expected
+    assert misc_utils.get_files(path_list, extension, index_file=index_file) == expected
+
+    os.remove(index_file)
+    shutil.rmtree(test_dir)
+
+
 def test_get_file_length():
     test_dir = './temp'
     misc_utils.make_dir_if_not_exist(test_dir)
@@ -136,6 +515,23 @@ def test_get_file_length():
         save_name = os.path.join(test_dir, 'dat.txt')
         misc_utils.save_file(save_name, text)
         assert misc_utils.get_file_length(save_name) == length
+        assert misc_utils.get_file_length(pathlib.Path(save_name)) == length
+
+    shutil.rmtree(test_dir)
+
+
+def test_get_file_length_list():
+    test_dir = './temp dir'
+    misc_utils.make_dir_if_not_exist(test_dir)
+    assert os.path.exists(test_dir)
+
+    lengths = [0, 1, 100, 1000]
+    save_names = []
+    for length in lengths:
+        save_name = os.path.join(test_dir, f'dat {length}.txt')
+        misc_utils.save_file(save_name, ['abcdefg\n'] * length + ['no newline'])
+        save_names.append(save_name)
+    assert misc_utils.get_file_length(save_names, workers=2) == lengths
 
     shutil.rmtree(test_dir)
 
@@ -158,8 +554,109 @@ def test_randomsplit_all(array, portions):
         assert len(final[cnt]) == int(len(array) * portions[cnt])
 
 
+@pytest.mark.parametrize('portions, sizes', [((0.33, 0.33, 0.34), [3, 3, 4]), ((0.25, 0.25, 0.5), [2, 2, 6])])
+def test_randomsplit_rest(portions, sizes):
+    # the elements left by the rounding are in the last split
+    final = misc_utils.random_split(np.arange(10), portions, seed=1)
+    assert [len(a) for a in final] == sizes
+    assert sorted(np.concatenate(final).tolist()) == list(range(10))
+
+
+def test_randomsplit_seed():
+    np.random.seed(0)
+    expected = np.random.random()
+    np.random.seed(0)
+    split_1 = misc_utils.random_split(np.arange(100), (0.5, 0.5), seed=1)
+    split_2 = misc_utils.random_split(np.arange(100), (0.5, 0.5), seed=1)
+    # the global random state is not touched
+    assert np.random.random() == expected
+    for a, b in zip(split_1, split_2):
+        np.testing.assert_array_equal(a, b)
+    assert sorted(np.concatenate(split_1).tolist()) == list(range(100))
+
+
+def test_randomsplit_types():
+    import pandas as pd
+
+    df = pd.DataFrame({'a': np.arange(100)})
+    idx = misc_utils.random_split(np.arange(100), (0.3, 0.7), seed=1, return_indices=True)
+    df_splits = misc_utils.random_split(df, (0.3, 0.7), seed=1)
+    for i, df_split in zip(idx, df_splits):
+        np.testing.assert_array_equal(df_split['a'].to_numpy(), i)
+
+
+def test_randomsplit_stratify():
+    labels = np.array([0] * 100 + [1] * 50 + [2] * 10)
+    splits = misc_utils.random_split(np.arange(160), (0.6, 0.2, 0.2), seed=1, stratify=labels)
+    for split, portion in zip(splits, (0.6, 0.2, 0.2)):
+        assert np.all(np.abs(np.bincount(labels[split], minlength=3) - np.array([100, 50, 10]) * portion) < 1)
+    assert len(np.unique(np.concatenate(splits))) == sum(len(a) for a in splits) == 160
+
+
+@pytest.mark.parametrize('label_size, portions', [(4, (0.7, 0.3)), (3, (0.8, 0.2)), (1, (0.5, 0.3, 0.2))])
+def test_randomsplit_stratify_small_labels(label_size, portions):
+    labels = np.repeat(np.arange(1000), label_size)
+    splits = misc_utils.random_split(labels, portions, seed=1, stratify=labels, return_indices=True)
+    # the rest elements of every label are kept and the split sizes are close to the portions
+    assert np.array_equal(np.sort(np.concatenate(splits)), np.arange(len(labels)))
+    for split, portion in zip(splits, portions):
+        assert len(split) > 0 and abs(len(split) - len(labels) * portion) <= 0.02 * len(labels)
+        assert np.all(np.abs(np.bincount(labels[split], minlength=1000) - label_size * portion) < 1)
+
+
+def test_randomsplit_groups():
+    groups = np.repeat(np.arange(20), 5)
+    splits = misc_utils.random_split(np.arange(100), (0.8, 0.2), seed=1, groups=groups)
+    assert sum(len(a) for a in splits) == 100
+    assert not set(groups[splits[0]]) & set(groups[splits[1]])
+    assert len(splits[0]) == 80
+
+
 @pytest.mark.parametrize('array', [np.arange(100), ['a', 10, None, ('b', 2), 11, 12, 13, 14, 15, 16]])
 @pytest.mark.parametrize('portions', [(0.1, 0.2, 0.8), (0.1, -0.5)])
 def test_randomsplit_error(array, portions):
     with pytest.raises(ValueError):
         misc_utils.random_split(array, portions)
+
+
+def test_lazy_import():
+    code = ('import sys, toolman; heavy = [m for m in ("torch", "cv2", "matplotlib", "skimage", "pandas") '
+            'if m in sys.modules]; assert not heavy, heavy; toolman.misc_utils; assert "toolman.misc_utils" in sys.modules')
+    subprocess.check_call([sys.executable, '-c', code])
+
+
+@pytest.mark.parametrize('mode, relative', [
+    ('symlink', False),
+    ('symlink', True),
+    ('hardlink', False),
+    ('copy', False),
+])
+def test_create_symlinks(mode, relative):
+    test_dir = './temp'
+    source_dir = os.path.join(test_dir, 'source')
+    dest_dir = os.path.join(test_dir, 'dest')
+    misc_utils.make_dir_if_not_exist(source_dir)
+
+    source_files = [os.path.abspath(os.path.join(source_dir, f'dat_{i}.txt')) for i in range(10)]
+    for i, f in enumerate(source_files):
+        misc_utils.save_file(f, [str(i)])
+
+    summary = misc_utils.create_symlinks(source_files[:5], dest_dir, mode=mode, relative=relative, verbose=False)
+    assert summary == {'created': 5, 'skipped': 0, 'failed': []}
+    summary = misc_utils.create_symlinks(source_files + [os.path.join(source_dir, 'missing.txt')], dest_dir,
+                                         mode=mode, relative=relative, verbose=False)
+    # dangling symbolic links can be created, while hard links and copies fail
+    assert summary['created'] == (6 if mode == 'symlink' else 5) and summary['skipped'] == 5
+    assert len(summary['failed']) == (0 if mode == 'symlink' else 1)
+    for i in range(10):
+        target_file = os.path.join(dest_dir, f'dat_{i}.txt')
+        assert misc_utils.load_file(target_file) == [str(i)]
+        assert os.path.islink(target_file) == (mode == 'symlink')
+        if mode == 'symlink':
+            assert os.path.isabs(os.readlink(target_file)) != relative
+
+    summary = misc_utils.create_symlinks(source_files, dest_dir, mode=mode, overwrite=True, verbose=False)
+    assert summary == {'created': 10, 'skipped': 0, 'failed': []}
+    assert len([a for a in os.listdir(dest_dir) if '.tmp-' in a]) == 0
+
+    shutil.rmtree(test_dir)
@@ -5,7 +5,14 @@
 
 # Built-in
 import os
+import sys
+import json
+import time
 import shutil
+import socket
+import threading
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
 
 # Libs
 import pytest
@@ -14,6 +21,8 @@ import numpy as np
 # Own modules
 from toolman import process_block, misc_utils
 
+requires_pickle5 = pytest.mark.skipif(sys.version_info < (3, 8), reason='pickle protocol 5 requires python 3.8')
+
 
 @pytest.mark.parametrize('shape', [
     (512, 512, 3),
@@ -38,3 +47,419 @@ def test_pb(shape, ext):
     np.testing.assert_array_equal(shape, img.shape)
 
     shutil.rmtree(test_dir)
+
+
+def test_pb_cache_key():
+    calls = []
+
+    def func(a, b=None):
+        calls.append((a, b))
+        return np.ones(100) * a
+
+    test_dir = './temp_pb'
+    pb = process_block.ProcessBlock(func, test_dir)
+    np.testing.assert_array_equal(pb.run(a=1, b={'x': 1, 'y': 2}), np.ones(100))
+    np.testing.assert_array_equal(pb.run(a=2, b={'x': 1, 'y': 2}), np.ones(100) * 2)
+    # same kwargs in a different order are loaded from cache
+    np.testing.assert_array_equal(pb.run(b={'y': 2, 'x': 1}, a=1), np.ones(100))
+    assert len(calls) == 2
+    assert pb.get_key(a=1) != pb.get_key(a=np.array(1)) != pb.get_key(a=2)
+
+    # changing the function invalidates the results
+    def func(a, b=None):
+        calls.append((a, b))
+        return np.zeros(100)
+
+    pb = process_block.ProcessBlock(func, test_dir)
+    np.testing.assert_array_equal(pb.run(a=1, b={'x': 1, 'y': 2}), np.zeros(100))
+    assert len(calls) == 3
+
+    shutil.rmtree(test_dir)
+
+
+def test_pb_cache_key_canonical():
+    code = ('from toolman import process_block; '
+            'pb = process_block.ProcessBlock(process_block.detect_serializer, "./temp_pb"); '
+            'print(pb.get_key(a={"x", "y", "z", "w"}, b=frozenset([1, 2, (3, "4")]), c=[{"p": {1.5}}]))')
+    keys = set()
+    for seed in ['1', '2', '3']:
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        keys.add(subprocess.check_output([sys.executable, '-c', code], env=env).strip())
+    assert len(keys) == 1
+
+    pb = process_block.ProcessBlock(process_block.detect_serializer, './temp_pb')
+    assert pb.get_key(a={1, 2}) == pb.get_key(a={2, 1}) != pb.get_key(a=frozenset([1, 2])) != pb.get_key(a={1, 3})
+    with pytest.raises(TypeError):
+        pb.get_key(a=threading.Lock())
+
+    shutil.rmtree('./temp_pb')
+
+
+def test_pb_prune_cache():
+    def func(a):
+        return np.random.random(1000)
+
+    test_dir = './temp_pb'
+    pb = process_block.ProcessBlock(func, test_dir, max_cache_size=3 * 8500)
+    for a in range(3):
+        pb.run(a=a)
+        os.utime(pb._find_value_file(pb.get_key(a=a))[1], (a, a))
+    # a=0 is the least recently used one
+    pb.run(a=3)
+    assert sorted(pb._get_cached_keys().keys()) == sorted(pb.get_key(a=a) for a in [1, 2, 3])
+
+    shutil.rmtree(test_dir)
+
+
+def load_data(n):
+    return np.arange(n)
+
+
+def add_one(data):
+    return data + 1
+
+
+def mul_two(data):
+    return data * 2
+
+
+def combine(x, y):
+    return np.concatenate([x, y])
+
+
+@pytest.mark.parametrize('workers, backend', [(None, 'process'), (2, 'thread'), (2, 'process')])
+def test_pipeline(workers, backend):
+    test_dir = './temp_pb'
+    pipe = process_block.Pipeline()
+    pipe.add(process_block.ProcessBlock(load_data, test_dir), n=5)
+    pipe.add(process_block.ProcessBlock(add_one, test_dir), depends={'data': 'load_data'})
+    pipe.add(process_block.ProcessBlock(mul_two, test_dir), depends={'data': 'load_data'})
+    pipe.add(process_block.ProcessBlock(combine, test_dir), depends={'x': 'add_one', 'y': 'mul_two'})
+
+    results = pipe.run(workers=workers, backend=backend)
+    np.testing.assert_array_equal(results['combine'], np.concatenate([np.arange(5) + 1, np.arange(5) * 2]))
+    assert set(pipe.timings.keys()) == {'load_data', 'add_one', 'mul_two', 'combine'}
+    path, total_time = pipe.critical_path()
+    assert path[0] == 'load_data' and path[-1] == 'combine' and len(path) == 3
+    assert total_time > 0
+
+    with pytest.raises(ValueError):
+        pipe.add(process_block.ProcessBlock(add_one, test_dir), depends=['missing'], name='other')
+
+    shutil.rmtree(test_dir)
+
+
+def test_pipeline_keys(monkeypatch):
+    test_dir = './temp_pb'
+
+    def make_pipe(n):
+        pipe = process_block.Pipeline()
+        pipe.add(process_block.ProcessBlock(load_data, test_dir), n=n)
+        pipe.add(process_block.ProcessBlock(add_one, test_dir), depends={'data': 'load_data'})
+        return pipe
+
+    make_pipe(5).run()
+    # downstream stages are keyed by the upstream keys, the cached upstream memmaps are not hashed
+    hashed = []
+    update_hash = process_block._update_hash
+    monkeypatch.setattr(process_block, '_update_hash', lambda h, obj: (hashed.append(type(obj)), update_hash(h, obj)))
+    results = make_pipe(5).run()
+    assert isinstance(results['load_data'], np.memmap) and np.memmap not in hashed
+    np.testing.assert_array_equal(results['add_one'], np.arange(5) + 1)
+    # changing the upstream parameters invalidates the downstream results
+    np.testing.assert_array_equal(make_pipe(6).run()['add_one'], np.arange(6) + 1)
+
+    shutil.rmtree(test_dir)
+
+
+def test_pipeline_lazy_results():
+    test_dir = './temp_pb'
+    pipe = process_block.Pipeline()
+    pipe.add(process_block.ProcessBlock(load_data, test_dir), n=5)
+    pipe.add(process_block.ProcessBlock(add_one, test_dir), depends={'data': 'load_data'})
+    for _ in range(2):
+        results = pipe.run(workers=2, backend='process')
+        # the results are loaded from the cache in this process instead of being pickled by the workers
+        assert isinstance(results['load_data'], np.memmap) and isinstance(results['add_one'], np.memmap)
+        np.testing.assert_array_equal(results['add_one'], np.arange(5) + 1)
+
+    # cached stages don't load their upstream results
+    block = process_block.ProcessBlock(add_one, test_dir)
+    key = block.get_key(data=process_block._UpstreamKey('missing'))
+    block._run(key, False, False, {'data': np.arange(3)})
+    missing = process_block._StageResult(process_block.ProcessBlock(load_data, test_dir), 'missing')
+    val, _ = process_block._run_stage(block, key, False, False, {'data': missing})
+    np.testing.assert_array_equal(val, np.arange(3) + 1)
+    with pytest.raises(IOError):
+        process_block._run_stage(block, key, True, False, {'data': missing})
+
+    shutil.rmtree(test_dir)
+
+
+def test_pb_cache_key_array(monkeypatch):
+    pb = process_block.ProcessBlock(process_block.detect_serializer, './temp_pb')
+    data = np.random.random((100, 30))
+    key = pb.get_key(a=data)
+    assert pb.get_key(a=np.asfortranarray(data)) == key
+    monkeypatch.setattr(process_block, 'HASH_CHUNK_BYTES', 1000)
+    assert pb.get_key(a=data) == key
+    assert pb.get_key(a=data[::2]) == pb.get_key(a=data[::2].copy()) != key
+    assert pb.get_key(a=np.zeros(0)) != pb.get_key(a=np.zeros((0, 3))) != pb.get_key(a=np.zeros((3, 0)))
+
+    def func(data):
+        return data.sum(axis=0)
+
+    pb = process_block.ProcessBlock(func, './temp_pb')
+    for _ in range(2):
+        np.testing.assert_array_equal(pb.run(data=np.zeros((0, 3))), np.zeros(3))
+
+    shutil.rmtree('./temp_pb')
+
+
+@pytest.mark.parametrize('serializer', [
+    None, 'pkl', 'npy', pytest.param('pkl5', marks=requires_pickle5), 'pkl.gz', 'npz'])
+def test_pb_serializer(serializer):
+    def func(shape):
+        return np.random.random(shape)
+
+    test_dir = './temp_pb'
+    pb = process_block.ProcessBlock(func, test_dir, serializer=serializer)
+    val = pb.run(shape=(64, 64))
+    val_read = pb.run(shape=(64, 64))
+    np.testing.assert_array_equal(val, val_read)
+    if serializer in [None, 'npy', 'pkl5']:
+        # arrays are memory-mapped
+        assert not val_read.flags.owndata and not val_read.flags.writeable
+    del val_read
+
+    shutil.rmtree(test_dir)
+
+
+@pytest.mark.parametrize('serializer', ['npy', 'npz'])
+def test_pb_serializer_array_only(serializer):
+    def func(a):
+        return {'a': np.arange(a)}
+
+    test_dir = './temp_pb'
+    pb = process_block.ProcessBlock(func, test_dir, serializer=serializer)
+    with pytest.raises(ValueError):
+        pb.run(a=3)
+    # the failed run is not marked as complete
+    assert not pb.check_complete(pb._get_file(pb.get_key(a=3), '_state.json'))
+    assert pb._find_value_file(pb.get_key(a=3)) == (None, None)
+
+    shutil.rmtree(test_dir)
+
+
+@requires_pickle5
+def test_pb_serializer_pickle5():
+    def func():
+        return {'a': np.arange(100), 'b': [np.ones((3, 3)), 'abc'], 'c': 1}
+
+    test_dir = './temp_pb'
+    pb = process_block.ProcessBlock(func, test_dir, serializer='pkl5')
+    val = pb.run()
+    val_read = pb.run()
+    np.testing.assert_array_equal(val['a'], val_read['a'])
+    np.testing.assert_array_equal(val['b'][0], val_read['b'][0])
+    assert val_read['b'][1] == 'abc' and val_read['c'] == 1
+    del val_read
+
+    with pytest.raises(ValueError):
+        process_block.ProcessBlock(func, test_dir, serializer='missing')
+
+    shutil.rmtree(test_dir)
+
+
+@pytest.mark.parametrize('resumable', [True, False])
+def test_pb_chunks(resumable):
+    calls = []
+    preempt = {'at': 3}
+
+    def func(n):
+        for i in range(n):
+            calls.append(i)
+            if i == preempt['at']:
+                raise RuntimeError('preempted')
+            yield np.ones(10) * i
+
+    def func_resumable(n, start_chunk=0):
+        for i in range(start_chunk, n):
+            calls.append(i)
+            if i == preempt['at']:
+                raise RuntimeError('preempted')
+            yield np.ones(10) * i
+
+    test_dir = './temp_pb'
+    pb = process_block.ProcessBlock(func_resumable if resumable else func, test_dir, process_name='func')
+    with pytest.raises(RuntimeError):
+        pb.run(n=5)
+    preempt['at'] = None
+    calls.clear()
+    val = pb.run(n=5)
+    assert calls == ([3, 4] if resumable else [0, 1, 2, 3, 4])
+    assert len(val) == 5
+    np.testing.assert_array_equal(val[2], np.ones(10) * 2)
+    np.testing.assert_array_equal(val.concatenate(), np.repeat(np.arange(5), 10))
+
+    calls.clear()
+    val = pb.run(n=5)
+    assert calls == [] and len(val) == 5
+
+    shutil.rmtree(test_dir)
+
+
+def slow_count(log_file, sleep_time):
+    with open(log_file, 'a') as f:
+        f.write('run\n')
+    time.sleep(sleep_time)
+    return np.arange(10)
+
+
+def _dead_pid():
+    proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+    proc.wait()
+    return proc.pid
+
+
+def test_pb_lock():
+    test_dir = './temp_pb'
+    log_file = os.path.abspath(os.path.join(test_dir, 'log.txt'))
+    pb = process_block.ProcessBlock(slow_count, test_dir)
+    with ProcessPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(pb.run, verbose=False, log_file=log_file, sleep_time=1) for _ in range(3)]
+        results = [a.result() for a in futures]
+    for val in results:
+        np.testing.assert_array_equal(val, np.arange(10))
+    assert misc_utils.get_file_length(log_file) == 1
+
+    state = misc_utils.load_file(pb._get_file(pb.get_key(log_file=log_file, sleep_time=1), '_state.json'))
+    assert state['status'] == 'Complete' and state['duration'] >= 1
+    assert state['host'] == socket.gethostname()
+
+    shutil.rmtree(test_dir)
+
+
+def test_pb_stale_lock():
+    test_dir = './temp_pb'
+    log_file = os.path.abspath(os.path.join(test_dir, 'log.txt'))
+    pb = process_block.ProcessBlock(slow_count, test_dir, stale_timeout=5)
+    lock_file = pb._get_file(pb.get_key(log_file=log_file, sleep_time=0), '.lock')
+
+    # the owner of the lock has exited
+    with open(lock_file, 'w') as f:
+        json.dump({'pid': _dead_pid(), 'host': socket.gethostname(), 'time': time.time()}, f)
+    np.testing.assert_array_equal(pb.run(log_file=log_file, sleep_time=0), np.arange(10))
+    assert not os.path.exists(lock_file)
+
+    # the lock has no heartbeat from another node
+    with open(lock_file, 'w') as f:
+        json.dump({'pid': 1, 'host': 'other_node', 'time': time.time()}, f)
+    os.utime(lock_file, (time.time() - 10, time.time() - 10))
+    np.testing.assert_array_equal(pb.run(log_file=log_file, sleep_time=0, force_run=True), np.arange(10))
+    assert misc_utils.get_file_length(log_file) == 2
+
+    shutil.rmtree(test_dir)
+
+
+def test_file_lock_stale_race():
+    test_dir = './temp_pb'
+    misc_utils.make_dir_if_not_exist(test_dir)
+    lock_file = os.path.join(test_dir, 'a.lock')
+    with open(lock_file, 'w') as f:
+        json.dump({'pid': _dead_pid(), 'host': socket.gethostname(), 'time': time.time(), 'token': 'stale'}, f)
+
+    # both waiters find the lock stale, b breaks it and acquires the lock first
+    lock_b, lock_c = process_block.FileLock(lock_file), process_block.FileLock(lock_file, poll_interval=0.1)
+    stale_owner = lock_c._get_stale_owner()
+    assert stale_owner['token'] == lock_b._get_stale_owner()['token'] == 'stale'
+    lock_b.acquire()
+    # c must not break the live lock of b
+    assert not lock_c._remove(stale_owner['token'], stale_owner['mtime'])
+    assert lock_c._read_owner()['token'] == lock_b._token
+    lock_c._token = 'other'
+    lock_c.release()
+    assert lock_c._read_owner()['token'] == lock_b._token
+    lock_b.release()
+    assert not os.path.exists(lock_file)
+
+    # both waiters find the mutex of a dead process stale, b breaks it and acquires the mutex first
+    mutex_file = lock_file + '.mutex'
+    with open(mutex_file, 'w') as f:
+        json.dump({'pid': _dead_pid(), 'host': socket.gethostname(), 'time': time.time(), 'token': 'stale'}, f)
+    os.utime(mutex_file, (time.time() - 100, time.time() - 100))
+    stale_owner = lock_c._read_owner(mutex_file)
+    _, mutex_token = lock_b._acquire_mutex()
+    # c must not break the fresh mutex of b
+    lock_c._break(mutex_file, stale_owner)
+    assert lock_c._read_owner(mutex_file)['token'] == mutex_token
+    lock_c._release_mutex(mutex_file, 'other')
+    assert os.path.exists(mutex_file)
+    lock_b._release_mutex(mutex_file, mutex_token)
+    assert sorted(os.listdir(test_dir)) == []
+
+    # a stale mutex alone is broken
+    with open(mutex_file, 'w') as f:
+        json.dump({'pid': _dead_pid(), 'host': socket.gethostname(), 'time': time.time(), 'token': 'stale'}, f)
+    os.utime(mutex_file, (time.time() - 100, time.time() - 100))
+    with lock_b:
+        assert lock_b._read_owner()['token'] == lock_b._token
+    assert sorted(os.listdir(test_dir)) == []
+
+    shutil.rmtree(test_dir)
+
+
+def hold_lock(lock_file, log_file, start_time):
+    time.sleep(max(start_time - time.time(), 0))
+    with process_block.FileLock(lock_file, poll_interval=0.05):
+        with open(log_file, 'a') as f:
+            f.write('enter\n')
+        time.sleep(0.2)
+        with open(log_file, 'a') as f:
+            f.write('exit\n')
+
+
+def test_file_lock_stale_waiters():
+    test_dir = './temp_pb'
+    misc_utils.make_dir_if_not_exist(test_dir)
+    lock_file = os.path.abspath(os.path.join(test_dir, 'a.lock'))
+    log_file = os.path.abspath(os.path.join(test_dir, 'log.txt'))
+    with open(lock_file, 'w') as f:
+        json.dump({'pid': _dead_pid(), 'host': socket.gethostname(), 'time': time.time(), 'token': 'stale'}, f)
+
+    start_time = time.time() + 1
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        for future in [executor.submit(hold_lock, lock_file, log_file, start_time) for _ in range(4)]:
+            future.result()
+    # the waiters held the lock one after another
+    assert [a.strip() for a in misc_utils.load_file(log_file)] == ['enter', 'exit'] * 4
+    assert not os.path.exists(lock_file)
+    assert sorted(os.listdir(test_dir)) == ['log.txt']
+
+    shutil.rmtree(test_dir)
+
+
+def scale(log_file, a, b):
+    with open(log_file, 'a') as f:
+        f.write('run\n')
+    return np.ones(4) * a * b
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_pb_map(workers):
+    test_dir = './temp_pb'
+    log_file = os.path.abspath(os.path.join(test_dir, 'log.txt'))
+    pb = process_block.ProcessBlock(scale, test_dir)
+
+    results = pb.map([{'log_file': log_file, 'a': 1, 'b': 2}, {'log_file': log_file, 'a': 3, 'b': 4}],
+                     workers=workers)
+    np.testing.assert_array_equal(results[0], np.ones(4) * 2)
+    np.testing.assert_array_equal(results[1], np.ones(4) * 12)
+
+    # the first shard of the grid is already finished
+    results = pb.map({'log_file': [log_file], 'a': [1, 2], 'b': [2, 3]}, workers=workers)
+    for val, (a, b) in zip(results, [(1, 2), (1, 3), (2, 2), (2, 3)]):
+        np.testing.assert_array_equal(val, np.ones(4) * a * b)
+    assert misc_utils.get_file_length(log_file) == 5
+
+    shutil.rmtree(test_dir)
@@ -8,9 +8,12 @@
 # Libs
 import pytest
 import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
 
 # Own modules
-from toolman import vis_utils
+from toolman import vis_utils, img_utils
 
 
 @pytest.mark.parametrize('shape', [
@@ -32,3 +35,35 @@ def test_decode_label_map(shape, label_num):
             else:
                 print(label_map.shape, mask.shape)
                 np.testing.assert_array_equal(label_map[0, i, j], label_colors[mask[0, i, j]])
+
+
+@pytest.mark.parametrize('label_num', [2, 30])
+def test_decode_label_map_colors(label_num):
+    mask = np.random.randint(0, label_num, (2, 64, 64))
+    label_colors = {i: (i, 2 * i, 3 * i) for i in range(label_num)}
+    label_map = vis_utils.decode_label_map(mask, label_num, label_colors)
+    assert label_map.shape == (2, 64, 64, 3) and label_map.dtype == np.uint8
+    np.testing.assert_array_equal(label_map[..., 0], mask)
+    np.testing.assert_array_equal(label_map[..., 2], 3 * mask)
+
+    # default colors are cycled when there are more classes than colors
+    color_list = vis_utils.get_color_list()
+    label_map = vis_utils.decode_label_map(mask, label_num)
+    for i in range(1, label_num):
+        if np.any(mask == i):
+            np.testing.assert_array_equal(label_map[mask == i][0], color_list[i % len(color_list)])
+
+
+def test_overlay_polygons():
+    img = np.zeros((64, 64), dtype=np.uint8)
+    img[10:20, 10:30] = 1
+    img[40:60, 5:15] = 1
+    polygons = img_utils.seg_to_polygon(img)
+
+    _, ax = plt.subplots()
+    vis_utils.overlay_polygons(polygons, ax=ax)
+    assert len(ax.collections) == 1
+    assert len(ax.collections[0].get_paths()) == len(polygons)
+    vis_utils.overlay_polygons(polygons.tolist(), ax=ax)
+    assert len(ax.patches) == len(polygons)
+    plt.close()
@@ -4,14 +4,17 @@
 
 
 # Built-in
+from functools import lru_cache
 
 # Libs
 import numpy as np
 import matplotlib.pyplot as plt
+import matplotlib.colors as mcolors
 import matplotlib.patches as patches
+from matplotlib.collections import PolyCollection
 
 # Own modules
-from .img_utils import change_channel_order
+from .img_utils import change_channel_order, Polygons
 
 
 def get_default_colors():
@@ -30,35 +33,43 @@ def get_color_list():
     :return:
     """
     colors = get_default_colors()
-    return [tuple(int(a.lstrip('#')[i:i+2], 16) for i in (0, 2, 4)) for a in colors]
+    return [tuple(int(round(c * 255)) for c in mcolors.to_rgb(a)) for a in colors]
+
+
+@lru_cache(maxsize=None)
+def _get_default_palette(label_num):
+    """
+    Get the default palette of label_num classes, the first class is white and the others cycle through the plt default
+    colors, the palette is built once for each label_num
+    :param label_num: #distinct classes
+    :return: label_num * 3 uint8 array, read-only
+    """
+    color_list = get_color_list()
+    palette = np.array([color_list[i % len(color_list)] for i in range(label_num)], dtype=np.uint8).reshape(-1, 3)
+    palette[0] = (255, 255, 255)
+    palette.flags.writeable = False
+    return palette
 
 
 def decode_label_map(label, label_num=2, label_colors=None):
     """
-    #TODO this could be more efficient
     Decode label prediction map into rgb color map
     :param label: label prediction map
     :param label_num: #distinct classes in ground truth
-    :param label_colors: list of tuples with RGB value of label colormap
+    :param label_colors: dict maps label to tuple with RGB value, or list of RGB tuples of each label
     :return:
     """
     if len(label.shape) == 3:
         label = np.expand_dims(label, -1)
-    n, h, w, c = label.shape
-    outputs = np.zeros((n, h, w, 3), dtype=np.uint8)
     if not label_colors:
-        color_list = get_color_list()
-        label_colors = {}
-        for i in range(label_num):
-            label_colors[i] = color_list[i]
-        label_colors[0] = (255, 255, 255)
-    for i in range(n):
-        pixels = np.zeros((h, w, 3), dtype=np.uint8)
-        for j in range(h):
-            for k in range(w):
-                pixels[j, k] = label_colors[np.int(label[i, j, k, 0])]
-        outputs[i] = pixels
-    return outputs
+        palette = _get_default_palette(label_num)
+    else:
+        items = label_colors.items() if isinstance(label_colors, dict) else enumerate(label_colors)
+        items = list(items)
+        palette = np.zeros((max(k for k, _ in items) + 1, 3), dtype=np.uint8)
+        for k, v in items:
+            palette[k] = v
+    return palette[label[..., 0].astype(np.intp, copy=False)]
 
 
 def inv_normalize(img, mean, std):
@@ -268,16 +279,23 @@ def overlay_bboxes(bboxes, ax=None, linewidth=1, edgecolor='r', facecolor='none'
 def overlay_polygons(polygons, ax=None, linewidth=1, edgecolor='r', facecolor='none'):
     """
     Add polygons to the current figure
-    :param bboxes: list of bounding boxes, each element should in range of [xmin, ymin, xmax, ymax]
-    :param ax: the axes to add bouding boxes, if None, the current axes will be used
-    :param linewidth: the line width of the bboxes to be drawn
-    :param edgecolor: the edge color of the bboxes to be drawn
-    :param facecolor: the face color of the bboxes to be drawn, default is None
+    :param polygons: Polygons, or list of polygons, each element should be a list of [x, y]
+    :param ax: the axes to add polygons, if None, the current axes will be used
+    :param linewidth: the line width of the polygons to be drawn
+    :param edgecolor: the edge color of the polygons to be drawn
+    :param facecolor: the face color of the polygons to be drawn, default is None
     :return:
     """
     if ax is None:
         ax = plt.gca()
 
+    if isinstance(polygons, Polygons):
+        # draw all polygons as one collection from the views of the coords array
+        ax.add_collection(PolyCollection(list(polygons), facecolors=facecolor, edgecolors=edgecolor,
+                                         linewidths=linewidth))
+        ax.autoscale_view()
+        return
+
     for poly in polygons:
         x = [a[0] for a in poly]
         y = [a[1] for a in poly]